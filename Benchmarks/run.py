@@ -0,0 +1,224 @@
+"""
+Endpoint benchmark for `main:app`.
+
+Seeds a synthetic dataset, drives every router with concurrent requests and
+prints throughput and latency percentiles per endpoint as JSON, e.g.
+
+    python -m Benchmarks.run --products 20000 --requests 500 --concurrency 32 --output bench.json
+    python -m Benchmarks.run --baseline bench.json
+
+By default the app is served in-process through httpx's ASGI transport against
+a fresh SQLite file; pass --database-url to use a local Postgres and --uvicorn
+to benchmark a real uvicorn server instead.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+
+
+def _scenarios(sizes):
+    """
+    The requests sent to each endpoint, as (name, method, build) where `build`
+    returns the path and JSON body of one request.
+    """
+    products, orders = sizes["products"], sizes["orders"]
+    words = ("chair", "table", "lamp", "desk", "sofa", "mirror")
+
+    def order_body(rng):
+        return {
+            "customer_name": f"customer {rng.randint(1, 1000)}",
+            "customer_address": "1 main street",
+            "order_date": "2024-06-01T12:00:00",
+            "status": "pending",
+            "items": [
+                {"product_id": product_id, "quantity": 1}
+                for product_id in rng.sample(range(1, products + 1), rng.randint(1, 5))
+            ],
+        }
+
+    return [
+        ("GET /product/", "GET", lambda rng: (f"/product/?limit=100&after={rng.randint(0, products)}", None)),
+        ("GET /product/{id}", "GET", lambda rng: (f"/product/{rng.randint(1, products)}", None)),
+        ("GET /product/search/", "GET", lambda rng: (f"/product/search/?name={rng.choice(words)}&limit=20", None)),
+        ("POST /product/", "POST", lambda rng: ("/product/", {
+            "name": f"bench {rng.choice(words)}", "price": 9.99, "supplier_id": 1, "stock": 10, "warehouse_id": 1,
+        })),
+        ("PATCH /product/{id}/stock", "PATCH", lambda rng: (
+            f"/product/{rng.randint(1, products)}/stock", {"stock": rng.randint(100, 1000)},
+        )),
+        ("GET /orders/", "GET", lambda rng: (f"/orders/?limit=100&after={rng.randint(0, orders)}", None)),
+        ("GET /orders/{id}", "GET", lambda rng: (f"/orders/{rng.randint(1, orders)}", None)),
+        ("GET /orders/{id}/items", "GET", lambda rng: (f"/orders/{rng.randint(1, orders)}/items", None)),
+        ("POST /orders/", "POST", lambda rng: ("/orders/", order_body(rng))),
+        ("POST /supplier/", "POST", lambda rng: ("/supplier/", {"name": "bench supplier", "contact_info": "bench"})),
+        ("POST /warehouse/warehouse", "POST", lambda rng: (
+            "/warehouse/warehouse", {"location": "bench warehouse", "capacity": 1000},
+        )),
+    ]
+
+
+def _percentile(sorted_values, percent):
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, round(percent / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+async def _drive(client, method, build, requests, concurrency, rng):
+    latencies, errors, shed = [], 0, 0
+    pending = iter(range(requests))
+
+    async def worker():
+        nonlocal errors, shed
+        for _ in pending:
+            path, body = build(rng)
+            start = time.perf_counter()
+            try:
+                response = await client.request(method, path, json=body)
+                failed = response.status_code >= 500
+                # Shed by admission control rather than failed.
+                shed += response.status_code == 503
+            except httpx.HTTPError:
+                failed = True
+            latencies.append(time.perf_counter() - start)
+            errors += failed
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": requests,
+        "errors": errors,
+        "shed": shed,
+        "throughput_rps": round(requests / elapsed, 2),
+        "p50_ms": round(_percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(_percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(_percentile(latencies, 99) * 1000, 3),
+    }
+
+
+async def _run(base_url, transport, sizes, requests, concurrency, random_seed, only):
+    rng = random.Random(random_seed)
+    results = {}
+    async with httpx.AsyncClient(base_url=base_url, transport=transport, timeout=60) as client:
+        for name, method, build in _scenarios(sizes):
+            if only and not any(part in name for part in only):
+                continue
+            # A short warm up fills pools and caches before measuring.
+            await _drive(client, method, build, min(concurrency, requests), concurrency, rng)
+            results[name] = await _drive(client, method, build, requests, concurrency, rng)
+    return results
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _start_uvicorn(port):
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        env=os.environ.copy(),
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/health/pool", timeout=1)
+            return process
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("uvicorn did not start")
+
+
+def _compare(results, baseline):
+    """
+    Ratio of each metric against a previous run, > 1 means slower (or less throughput).
+    """
+    diff = {}
+    for name, current in results.items():
+        previous = baseline.get("endpoints", {}).get(name)
+        if not previous:
+            continue
+        diff[name] = {
+            "throughput": round(previous["throughput_rps"] / current["throughput_rps"], 3),
+            **{key: round(current[key] / previous[key], 3) for key in ("p50_ms", "p95_ms", "p99_ms") if previous[key]},
+        }
+    return diff
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default="sqlite:///bench.db")
+    parser.add_argument("--suppliers", type=int, default=50)
+    parser.add_argument("--warehouses", type=int, default=10)
+    parser.add_argument("--products", type=int, default=10000)
+    parser.add_argument("--orders", type=int, default=5000)
+    parser.add_argument("--items-per-order", type=int, default=5)
+    parser.add_argument("--requests", type=int, default=200, help="measured requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--only", nargs="*", help="only run endpoints whose name contains one of these")
+    parser.add_argument("--uvicorn", action="store_true", help="benchmark a uvicorn server instead of in-process")
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument("--baseline", help="previous JSON report to compare against")
+    args = parser.parse_args(argv)
+
+    # The app reads its database from the environment when it is imported.
+    os.environ["database_url"] = args.database_url
+    from Benchmarks.seed import seed
+    import main as app_module
+
+    sizes = seed(args.suppliers, args.warehouses, args.products, args.orders, args.items_per_order, args.seed)
+
+    process = None
+    if args.uvicorn:
+        port = _free_port()
+        process = _start_uvicorn(port)
+        base_url, transport = f"http://127.0.0.1:{port}", None
+    else:
+        base_url, transport = "http://bench", httpx.ASGITransport(app=app_module.app)
+    try:
+        results = asyncio.run(
+            _run(base_url, transport, sizes, args.requests, args.concurrency, args.seed, args.only)
+        )
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+
+    report = {
+        "config": {
+            "database": args.database_url.split("://")[0],
+            "server": "uvicorn" if args.uvicorn else "in-process",
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "seed": args.seed,
+        },
+        "dataset": sizes,
+        "endpoints": results,
+    }
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            report["compared_to_baseline"] = _compare(results, json.load(baseline))
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as report_file:
+            report_file.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
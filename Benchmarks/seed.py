@@ -0,0 +1,107 @@
+import random
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert, text
+
+from custom_function import Base, engine
+from migrations import migrate
+from Order import rollup, totals
+from Order.models import ORDER_STATUSES, Order, OrderItem
+from Product.models import Product
+from Supplier.models import Supplier
+from Warehouse.models import Warehouse
+
+SEED_CHUNK_SIZE = 5000
+WORDS = ("chair", "table", "lamp", "desk", "shelf", "sofa", "bed", "rug", "mirror", "stool", "cabinet", "bench")
+
+
+def _insert(conn, model, rows):
+    for start in range(0, len(rows), SEED_CHUNK_SIZE):
+        conn.execute(insert(model), rows[start:start + SEED_CHUNK_SIZE])
+
+
+def seed(suppliers=50, warehouses=10, products=10000, orders=5000, items_per_order=5, random_seed=42):
+    """
+    Filling the configured database with a synthetic, reproducible dataset.
+
+    Existing tables are dropped first so every run starts from the same data.
+
+    Args:
+        suppliers: Number of suppliers.
+        warehouses: Number of warehouses.
+        products: Number of products, spread over suppliers and warehouses.
+        orders: Number of orders.
+        items_per_order: Maximum number of items per order.
+        random_seed: Seed of the generator, the same seed gives the same dataset.
+
+    Returns:
+        A dict with the number of rows created per table.
+    """
+    rng = random.Random(random_seed)
+    Base.metadata.drop_all(engine)
+
+    start_date = datetime(2024, 1, 1)
+    order_items = []
+    # Indexes included, the deferred steps run on the empty tables.
+    migrate(engine)
+    with engine.begin() as conn:
+        _insert(conn, Supplier, [
+            {"id": i, "name": f"supplier {i}", "contact_info": f"supplier{i}@example.com"}
+            for i in range(1, suppliers + 1)
+        ])
+        _insert(conn, Warehouse, [
+            {"id": i, "location": f"warehouse {i}", "capacity": products * 1000}
+            for i in range(1, warehouses + 1)
+        ])
+        prices = {}
+        product_rows = []
+        for i in range(1, products + 1):
+            prices[i] = round(rng.uniform(1, 500), 2)
+            product_rows.append({
+                "id": i,
+                "name": f"{rng.choice(WORDS)} {rng.choice(WORDS)} {i}",
+                "description": f"a {rng.choice(WORDS)} for the {rng.choice(WORDS)}",
+                "price": prices[i],
+                "supplier_id": rng.randint(1, suppliers),
+                "stock": rng.randint(100, 1000),
+                "warehouse_id": rng.randint(1, warehouses),
+            })
+        _insert(conn, Product, product_rows)
+        _insert(conn, Order, [
+            {
+                "id": i,
+                "customer_name": f"customer {rng.randint(1, orders // 2 + 1)}",
+                "customer_address": f"{i} main street",
+                "order_date": start_date + timedelta(minutes=rng.randint(0, 60 * 24 * 365)),
+                "status": rng.choice(ORDER_STATUSES),
+            }
+            for i in range(1, orders + 1)
+        ])
+        for order_id in range(1, orders + 1):
+            for product_id in rng.sample(range(1, products + 1), rng.randint(1, items_per_order)):
+                order_items.append({
+                    "order_id": order_id,
+                    "product_id": product_id,
+                    "quantity": rng.randint(1, 5),
+                    "price": prices[product_id],
+                })
+        _insert(conn, OrderItem, order_items)
+        for start, stop in totals.id_batches(conn):
+            totals.repair_batch(conn, start, stop)
+        rollup.rebuild(conn)
+
+        if conn.dialect.name == "postgresql":
+            # Rows were inserted with explicit ids, move the sequences past them.
+            for model in (Supplier, Warehouse, Product, Order, OrderItem):
+                table = model.__tablename__
+                conn.execute(text(
+                    f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), (SELECT coalesce(max(id), 1) FROM {table}))"
+                ))
+
+    return {
+        "suppliers": suppliers,
+        "warehouses": warehouses,
+        "products": products,
+        "orders": orders,
+        "order_items": len(order_items),
+    }
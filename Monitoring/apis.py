@@ -0,0 +1,63 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+import admission
+from Product.cache import product_cache
+from custom_function import async_engine, pool_stats
+from metrics import metrics
+
+monitoring_app = APIRouter()
+
+metrics.add_gauges(lambda: {
+    f"db_pool_{name}": value for name, value in pool_stats.snapshot(async_engine.pool).items()
+})
+metrics.add_gauges(lambda: {
+    f"product_cache_{name}": value for name, value in product_cache.stats().items()
+})
+metrics.add_collector(admission.render_metrics)
+
+@monitoring_app.get("/health/pool")
+async def get_pool_stats():
+    """
+    Reporting the state of the database connection pool.
+
+    Returns:
+        A JSON object with checked-out and idle connections, overflow usage,
+        acquisition timeouts and the average/max time spent waiting for a connection.
+    """
+    return pool_stats.snapshot(async_engine.pool)
+
+
+@monitoring_app.get("/health/cache")
+async def get_cache_stats():
+    """
+    Reporting size and hit/miss/eviction counters of the read-through caches.
+
+    Returns:
+        A JSON object with the counters of each cache.
+    """
+    return {"product": product_cache.stats()}
+
+
+@monitoring_app.get("/health/admission")
+async def get_admission_stats():
+    """
+    Reporting the admission limits and how busy they are.
+
+    Returns:
+        A JSON object per router and kind ("/orders write", ...) with its
+        concurrency and queue limits, active and queued requests and the
+        number of requests shed so far.
+    """
+    return {f"{router} {kind}": limiter.stats() for (router, kind), limiter in sorted(admission.limiters.items())}
+
+
+@monitoring_app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """
+    Exposing request, database, pool and cache metrics in the Prometheus text format.
+
+    Returns:
+        The metrics as plain text, to be scraped by Prometheus.
+    """
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
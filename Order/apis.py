@@ -1,165 +1,575 @@
-from fastapi import Depends, APIRouter, HTTPException, status
-from sqlalchemy.orm import Session
+from datetime import date, datetime
+from typing import Any, Dict, List
 
-from Product.models import Product
-from custom_function import get_db
+import orjson
+from fastapi import Depends, APIRouter, HTTPException, Query, status
+from sqlalchemy import Integer, bindparam, case, delete, func, insert, literal, select, true
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
 
-from .schema import OrderCreate, StatusUpdate
-from .models import Order
+from Product.cache import product_cache
+from Product.models import Product
+from Product.stock import release_stock, reserve_stock, reserve_stock_lines
+from custom_function import (
+    DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, BulkResult, Message, bulk_insert, export_response, get_async_db, get_read_db,
+    paginate, select_fields, update_returning_previous,
+)
+from metrics import query_budget
+
+from .schema import (
+    DailyRevenue, OrderBulkCreate, OrderItemCreate, OrderItemRead, OrderPage, OrderRead, OrderUpdate, OrderWithItemsCreate,
+    StatusCount, StatusUpdate,
+)
+from .filters import ORDER_SORTS, filter_orders, order_index
+from .models import ORDER_STATUSES, Order, OrderItem
+from . import rollup, totals
 
 order_app = APIRouter()
 
-@order_app.get("/")
-async def get_all_orders(db: Session = Depends(get_db)):
+
+async def _order_quantities(db, order_id):
+    rows = await db.execute(
+        select(OrderItem.product_id, func.sum(OrderItem.quantity))
+        .where(OrderItem.order_id == order_id)
+        .group_by(OrderItem.product_id)
+    )
+    return dict(rows.all())
+
+
+def _status_values(new_status):
+    """
+    The columns to set for a status change, keeping `stock_reserved` in step with `_move_stock`.
+    """
+    if new_status == "cancelled":
+        return {"status": new_status, "stock_reserved": False}
+    # Evaluated against the row before the update: reopening a cancelled order reserves its stock.
+    reserved = case((Order.status == "cancelled", true()), else_=Order.stock_reserved)
+    return {"status": new_status, "stock_reserved": reserved}
+
+
+async def _move_stock(db, order_id, previous, new, reserved):
+    """
+    Moving the stock of an order along with its status change from `previous` to `new`.
+
+    Cancelling releases the stock the order reserved, reopening a cancelled
+    order reserves it again. `previous` and `reserved` come from the UPDATE
+    changing the status (see `update_returning_previous` and `_status_values`),
+    so a concurrent cancel cannot release the same stock twice.
+
+    Args:
+        reserved: Whether the order held its stock before the change, false
+            for orders created before reservations existed.
+
+    Returns:
+        The ids of the products whose stock changed.
+    """
+    if previous == new or "cancelled" not in (previous, new):
+        return []
+    if new == "cancelled" and not reserved:
+        return []
+
+    quantities = await _order_quantities(db, order_id)
+    if new == "cancelled":
+        await release_stock(db, quantities)
+    else:
+        product_id = await reserve_stock(db, quantities)
+        if product_id is not None:
+            await db.rollback()
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Not enough stock for product {product_id}")
+    return list(quantities)
+
+
+async def _evict_products(product_ids):
+    for product_id in product_ids:
+        await product_cache.delete(product_id)
+
+
+def _item_lines(dialect_name, items):
+    """
+    The `(product_id, quantity)` lines of a request as a table the database can join, sent as one parameter.
+
+    On PostgreSQL they go as two arrays unnested together, elsewhere (SQLite for
+    local testing) as a JSON array read with `json_each`.
+    """
+    if dialect_name == "postgresql":
+        return func.unnest(
+            bindparam("product_ids", [item.product_id for item in items], type_=ARRAY(Integer)),
+            bindparam("quantities", [item.quantity for item in items], type_=ARRAY(Integer)),
+        ).table_valued("product_id", "quantity").render_derived(name="lines")
+    lines = func.json_each(
+        bindparam("lines", orjson.dumps([[item.product_id, item.quantity] for item in items]).decode())
+    ).table_valued("value")
+    return select(
+        func.json_extract(lines.c.value, "$[0]").label("product_id"),
+        func.json_extract(lines.c.value, "$[1]").label("quantity"),
+    ).subquery("lines")
+
+
+def _rollup_key(order_date, order_status):
+    return (order_date.date() if order_date else None, order_status)
+
+
+async def _move_in_rollup(db, revenue, before, after):
+    """
+    Moving an order of `revenue` (its stored total) between (day, status) buckets of the stats rollup,
+    None meaning no bucket.
+    """
+    if before == after:
+        return
+    changes = {}
+    if before is not None:
+        changes[before] = (-1, -revenue)
+    if after is not None:
+        changes[after] = (1, revenue)
+    await rollup.record(db, changes)
+
+
+@order_app.get(
+    "/", response_model=OrderPage, response_model_exclude_unset=True, dependencies=[Depends(query_budget(1))],
+)
+async def get_all_orders(
+    order_status: str = Query(None, alias="status"),
+    order_date_from: datetime = None,
+    order_date_to: datetime = None,
+    customer_name: str = None,
+    sort: str = Query(None, pattern="^-?(id|order_date)$"),
+    after: str = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    fields: str = None,
+    db: AsyncSession = Depends(get_read_db),
+):
     """
-    Retrieving all orders
+    Retrieving orders one page at a time, optionally filtered and sorted.
+
+    Each filter and sort combination offered is served by its own index (see
+    `Order.filters.ORDER_INDEXES`), others are refused.
 
     Args:
+        order_status: Only the orders in this status (the `status` query parameter).
+        order_date_from: Only the orders placed at or after this date.
+        order_date_to: Only the orders placed before this date.
+        customer_name: Only the orders whose customer name starts with this text.
+        sort: "id", "order_date", or either prefixed with "-" for descending. Defaults
+            to "order_date" with a date range, which only that sort serves, "id" otherwise.
+            Sorting by date leaves out the orders without one.
+        after: The `next_cursor` of the previous page, omit it for the first page.
+        limit: Maximum number of orders in the page.
+        fields: Comma separated order fields to return (e.g. `id,status`), all of them when omitted.
+            The sort field is always returned.
         db: A database session dependency (fixture) for database access.
     
     Returns:
-         A list of JSON objects containing the order data else en empty list.
+         A JSON object with the page `items` and the `next_cursor` (null on the last page).
+
+    Raises:
+        HTTPException: 422 if the cursor does not belong to this sort, or for an
+            unsupported combination of filters and sort.
+    """
+    if sort is None:
+        sort = "order_date" if order_date_from is not None or order_date_to is not None else "id"
+    order_index(sort, order_status, order_date_from, order_date_to, customer_name)
+    sort_column, descending = ORDER_SORTS[sort]
+    columns = select_fields(Order, fields)
+    if sort_column is not None and sort_column.key not in {column.key for column in columns}:
+        columns.append(sort_column)
+    if sort_column is None and after is not None:
+        try:
+            after = int(after)
+        except ValueError:
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Invalid cursor")
+    query = filter_orders(select(*columns), order_status, order_date_from, order_date_to, customer_name)
+    return await paginate(db, query, Order.id, after, limit, sort_column, descending)
+
+
+@order_app.get("/export", dependencies=[Depends(query_budget(1))])
+async def export_orders(
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    order_status: str = Query(None, alias="status"),
+    order_date_from: datetime = None,
+    order_date_to: datetime = None,
+):
+    """
+    Exporting orders as a stream, for bulk consumers like BI pulls.
+
+    Args:
+        format: "ndjson" (default) or "csv".
+        order_status: Only export the orders in this status (the `status` query parameter).
+        order_date_from: Only export the orders placed at or after this date.
+        order_date_to: Only export the orders placed before this date.
+
+    Returns:
+        A streamed NDJSON or CSV file with one order per line.
     """
-    orders = db.query(Order).all()
-    return orders
+    query = filter_orders(select(*Order.__table__.columns), order_status, order_date_from, order_date_to)
+    query = query.order_by(Order.id)
+    return export_response(query, format, "orders")
 
 
-@order_app.post("/")
-async def create_order(order: OrderCreate, db: Session = Depends(get_db)):
+@order_app.get("/stats/status", response_model=List[StatusCount], dependencies=[Depends(query_budget(1))])
+async def get_order_counts_by_status(
+    date_from: date = None, date_to: date = None, db: AsyncSession = Depends(get_read_db)
+):
     """
-    Creating an order.
+    Counting orders per status, from the maintained stats rollup.
 
     Args:
-        orders: A JSON object of (`OrderCreate`) schema.
+        date_from: Only count the orders placed on or after this day.
+        date_to: Only count the orders placed on or before this day.
         db: A database session dependency (fixture) for database access.
 
     Returns:
-            A JSON of new created order data.
+        A JSON list with the number of orders of each status.
+    """
+    return (await db.execute(rollup.counts_by_status(date_from, date_to))).mappings().all()
+
+
+@order_app.get("/stats/revenue", response_model=List[DailyRevenue], dependencies=[Depends(query_budget(1))])
+async def get_revenue_by_day(
+    date_from: date = None, date_to: date = None, db: AsyncSession = Depends(get_read_db)
+):
+    """
+    Revenue and number of orders per day, cancelled orders excluded, from the maintained stats rollup.
+
+    Args:
+        date_from: First day to report.
+        date_to: Last day to report.
+        db: A database session dependency (fixture) for database access.
+
+    Returns:
+        A JSON list with the order count and revenue of each day.
+    """
+    return (await db.execute(rollup.revenue_by_day(date_from, date_to))).mappings().all()
+
+
+@order_app.post("/", response_model=OrderRead, dependencies=[Depends(query_budget(allow_repeats=True))])
+async def create_order(order: OrderWithItemsCreate, db: AsyncSession = Depends(get_async_db)):
     """
-    if order.status not in ("pending", "fulfilled", "cancelled"):
-        return {"message": 'pick status from these ("pending", "fulfilled", "cancelled")'}
+    Creating an order with its items, reserving their stock.
+
+    Prices are snapshotted from the products and the stock of every item is
+    reserved in the same transaction; the order is rejected if any product
+    runs short.
+
+    Args:
+        orders: A JSON object of (`OrderWithItemsCreate`) schema.
+        db: A database session dependency (fixture) for database access.
+
+    Returns:
+            A JSON of new created order data.
 
-    new_order = Order(**order.dict())
-    db.add(new_order)
-    db.commit()
-    db.refresh(new_order) 
+    Raises:
+        HTTPException: 422 for an unknown status, 404 if a product does not exist,
+            409 if a product does not have enough stock.
+    """
+    if order.status not in ORDER_STATUSES:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail='pick status from these ("pending", "fulfilled", "cancelled")',
+        )
+
+    quantities = {}
+    for item in order.items:
+        quantities[item.product_id] = quantities.get(item.product_id, 0) + item.quantity
+
+    prices = dict((await db.execute(select(Product.id, Product.price).where(Product.id.in_(quantities)))).all())
+    missing = sorted(set(quantities) - set(prices))
+    if missing:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Products not found: {missing}")
+
+    revenue = sum(item.quantity * (prices[item.product_id] or 0) for item in order.items)
+    # Insert first and reserve last, so the product rows stay locked as briefly as possible.
+    new_order = await db.scalar(
+        insert(Order)
+        .values(**order.model_dump(exclude={"items"}), total=revenue, item_count=len(order.items))
+        .returning(Order)
+    )
+    if order.items:
+        await db.execute(insert(OrderItem), [
+            {"order_id": new_order.id, "product_id": item.product_id, "quantity": item.quantity,
+             "price": prices[item.product_id]}
+            for item in order.items
+        ])
+    if order.status != "cancelled":
+        product_id = await reserve_stock(db, quantities)
+        if product_id is not None:
+            await db.rollback()
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Not enough stock for product {product_id}")
+    await rollup.record(db, {_rollup_key(new_order.order_date, new_order.status): (1, revenue)})
+    await db.commit()
+    await _evict_products(quantities)
     return new_order
 
 
-@order_app.get("/{order_id}")
-async def get_order_by_id(order_id: int, db: Session = Depends(get_db)):
+@order_app.post("/bulk", response_model=BulkResult, dependencies=[Depends(query_budget(allow_repeats=True))])
+async def create_orders_bulk(orders: List[Dict[str, Any]], db: AsyncSession = Depends(get_async_db)):
+    """
+    Creating many orders in one request.
+
+    The orders are created without items, rows with any other key (such as
+    `items`) are reported in `errors`: add the items with `POST /{order_id}/items`.
+
+    Args:
+        orders: A JSON list of (`OrderBulkCreate`) objects.
+        db: A database session dependency (fixture) for database access.
+
+    Returns:
+        A JSON object with the `created` orders (request index and id) and the
+        `errors` of the rows that were rejected.
+    """
+    def check(order):
+        if order.status not in ORDER_STATUSES:
+            return f"pick status from these {ORDER_STATUSES}"
+
+    async def on_insert(db, rows):
+        changes = {}
+        for row in rows:
+            key = (row["order_date"].date(), row["status"])
+            changes[key] = (changes.get(key, (0, 0))[0] + 1, 0)
+        await rollup.record(db, changes)
+
+    return await bulk_insert(db, Order, OrderBulkCreate, orders, check=check, on_insert=on_insert)
+
+
+@order_app.get(
+    "/{order_id}", response_model=OrderRead, response_model_exclude_unset=True,
+    dependencies=[Depends(query_budget(1))],
+)
+async def get_order_by_id(order_id: int, fields: str = None, db: AsyncSession = Depends(get_read_db)):
     """
     Retrieving an order by its ID.
 
     Args:
         order_id: An ID for which the order has to be search.
+        fields: Comma separated order fields to return, all of them when omitted.
         db: A database session dependency (fixture) for database access.
     
     Returns:
-             A JSON object containing the order data if found, or an error message if not found.
+             A JSON object containing the order data.
+
+    Raises:
+        HTTPException: If the order with the provided ID is not found.
     """
-    order = db.query(Order).filter(Order.id == order_id).first()
+    columns = select_fields(Order, fields)
+    order = (await db.execute(select(*columns).where(Order.id == order_id))).mappings().first()
     if order is None:
-        return {"message": "Order not found"}
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Order not found")
     return order
 
 
-@order_app.put("/{order_id}")
-async def update_product(order_id: int, order_update: OrderCreate = None, db: Session = Depends(get_db)):
+@order_app.put("/{order_id}", response_model=Message, dependencies=[Depends(query_budget(allow_repeats=True))])
+async def update_product(order_id: int, order_update: OrderUpdate = None, db: AsyncSession = Depends(get_async_db)):
     """
     Updates an existing order in the database.
 
-    This function takes an optional JSON object representing order updates (`OrderCreate`) and modifies the corresponding order record in the database.
+    Only the fields present in the JSON body (`OrderUpdate`) are changed, with a single UPDATE.
 
     Args:
         order_id: The ID of the order to update.
         order_update: A JSON object containing updated order data (optional).
-        db: A database session dependency injected using `Depends(get_db)`.
+        db: A database session dependency injected using `Depends(get_async_db)`.
 
     Returns:
         A JSON message indicating successful update.
     """
-    order = db.query(Order).filter(Order.id == order_id).first()
+    values = order_update.model_dump(exclude_unset=True) if order_update else {}
+    if "status" in values and values["status"] not in ORDER_STATUSES:
+        return {"message": 'Choose status from these "pending", "fulfilled", "cancelled" '}
+    if not values:
+        if await db.scalar(select(Order.id).where(Order.id == order_id)) is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Order not found")
+        return {"message": 'Updated'}
+
+    if "status" in values:
+        values.update(_status_values(values["status"]))
+    order = await update_returning_previous(
+        db, Order, order_id, values, [Order.status, Order.order_date, Order.stock_reserved],
+    )
     if order is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Order not found")
-
-    if order_update:
-        for field, value in order_update.dict().items():
-            if value is not None:
-                setattr(order, field, value)
-
-    db.commit()
+    product_ids = await _move_stock(
+        db, order_id, order["previous_status"], order["status"], order["previous_stock_reserved"],
+    )
+    await _move_in_rollup(
+        db, order["total"],
+        _rollup_key(order["previous_order_date"], order["previous_status"]),
+        _rollup_key(order["order_date"], order["status"]),
+    )
+
+    await db.commit()
+    await _evict_products(product_ids)
     return {"message": 'Updated'}
 
 
-@order_app.delete("/{order_id}")
-async def delete_order(order_id: int, db: Session = Depends(get_db)):
+@order_app.delete("/{order_id}", response_model=Message, dependencies=[Depends(query_budget(allow_repeats=True))])
+async def delete_order(order_id: int, db: AsyncSession = Depends(get_async_db)):
     """
     Deletes a order from the database.
 
-    This function removes a order record from the database based on the provided `order_id`.
+    This function removes a order record and its items from the database based on the provided `order_id`,
+    giving back the stock the order still holds: fulfilled orders have shipped theirs, cancelled
+    ones and those created before reservations existed hold none.
 
     Args:
         order_id: The ID of the order to delete.
-        db: A database session dependency injected using `Depends(get_db)`.
+        db: A database session dependency injected using `Depends(get_async_db)`.
 
     Returns:
         A JSON message indicating successful deletion.
     """
-    order = db.query(Order).filter(Order.id == order_id).first()
+    items = await db.execute(
+        delete(OrderItem)
+        .where(OrderItem.order_id == order_id)
+        .returning(OrderItem.product_id, OrderItem.quantity)
+    )
+    items = items.all()
+    order = (await db.execute(
+        delete(Order)
+        .where(Order.id == order_id)
+        .returning(Order.status, Order.order_date, Order.total, Order.stock_reserved)
+    )).first()
     if order is None:
+        await db.rollback()
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Order not found")
 
-    db.delete(order)
-    db.commit()
+    quantities = {}
+    for product_id, quantity in items:
+        quantities[product_id] = quantities.get(product_id, 0) + (quantity or 0)
+    if order.stock_reserved and order.status != "fulfilled":
+        await release_stock(db, quantities)
+    await rollup.record(db, {_rollup_key(order.order_date, order.status): (-1, -order.total)})
+    await db.commit()
+    await _evict_products(quantities)
 
     return {"message": "Order deleted successfully"}
 
 
-@order_app.patch("/{order_id}/status")
-async def update_order_status(order_id: int, status_update: StatusUpdate, db: Session = Depends(get_db)):
+@order_app.patch("/{order_id}/status", response_model=Message, dependencies=[Depends(query_budget(allow_repeats=True))])
+async def update_order_status(order_id: int, status_update: StatusUpdate, db: AsyncSession = Depends(get_async_db)):
     """
     Updating order status with a valid status.
 
+    Cancelling an order releases the stock of its items, reopening a
+    cancelled order reserves it again.
+
     Args:
         order_id: An Integer if order id for which we have to change the stock
         db: A database session dependency (fixture) for database access.
     """
-    if status_update.status not in ("pending", "fulfilled", "cancelled"):
+    if status_update.status not in ORDER_STATUSES:
         return {"message": 'Choose status from these "pending", "fulfilled", "cancelled" '}
-    order = db.query(Order).filter(Order.id == order_id).first()
+    order = await update_returning_previous(
+        db, Order, order_id, _status_values(status_update.status), [Order.status, Order.stock_reserved],
+    )
     if order is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Order not found")
 
-    order.status = status_update.status
-    db.commit()
+    product_ids = await _move_stock(
+        db, order_id, order["previous_status"], order["status"], order["previous_stock_reserved"],
+    )
+    await _move_in_rollup(
+        db, order["total"],
+        _rollup_key(order["order_date"], order["previous_status"]),
+        _rollup_key(order["order_date"], order["status"]),
+    )
+    await db.commit()
+    await _evict_products(product_ids)
     return {"message": "ORder status updated successfully"}
 
 
-@order_app.get("/{order_id}/items")
-async def get_order_items(order_id: int, db: Session = Depends(get_db)):
+@order_app.post(
+    "/{order_id}/items", response_model=List[OrderItemRead], response_model_exclude_unset=True,
+    dependencies=[Depends(query_budget(6))],
+)
+async def add_order_items(order_id: int, items: List[OrderItemCreate], db: AsyncSession = Depends(get_async_db)):
+    """
+    Adding items to an order, reserving their stock.
+
+    All the lines are inserted with a single INSERT ... SELECT joined to the
+    products, so the prices are snapshotted by the database, and their stock
+    is reserved with one UPDATE over the same lines: a request with thousands
+    of lines costs the same few statements as one with a single line. The
+    stored totals of the order and its stats rollup are updated in the same
+    transaction.
+
+    Args:
+        order_id: The ID of the order to add the items to.
+        items: A JSON list of (`OrderItemCreate`) lines.
+        db: A database session dependency (fixture) for database access.
+
+    Returns:
+        A JSON list of the inserted order items with their price.
+
+    Raises:
+        HTTPException: 404 if the order or a product does not exist,
+            409 if a product does not have enough stock.
+    """
+    # Locking the order, so a concurrent status change sees the new items and stock.
+    order = (await db.execute(
+        select(Order.status, Order.order_date, Order.stock_reserved).where(Order.id == order_id).with_for_update()
+    )).first()
+    if order is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Order not found")
+    if not items:
+        return []
+
+    lines = _item_lines(db.bind.dialect.name, items)
+    inserted = (await db.execute(
+        insert(OrderItem)
+        .from_select(
+            ["order_id", "product_id", "quantity", "price"],
+            select(literal(order_id), Product.id, lines.c.quantity, Product.price)
+            .join_from(lines, Product, Product.id == lines.c.product_id),
+        )
+        .returning(OrderItem.id, OrderItem.order_id, OrderItem.product_id, OrderItem.quantity, OrderItem.price)
+    )).mappings().all()
+
+    quantities = {}
+    for item in items:
+        quantities[item.product_id] = quantities.get(item.product_id, 0) + item.quantity
+    missing = sorted(set(quantities) - {item["product_id"] for item in inserted})
+    if missing:
+        await db.rollback()
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Products not found: {missing}")
+
+    # Cancelled orders and those created before reservations existed hold no stock, their new lines neither.
+    if order.stock_reserved:
+        product_id = await reserve_stock_lines(db, lines, quantities)
+        if product_id is not None:
+            await db.rollback()
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Not enough stock for product {product_id}")
+    revenue = sum(item["quantity"] * (item["price"] or 0) for item in inserted)
+    await totals.add(db, order_id, revenue, len(inserted))
+    await rollup.record(db, {_rollup_key(order.order_date, order.status): (0, revenue)})
+    await db.commit()
+    await _evict_products(quantities)
+    return inserted
+
+
+@order_app.get("/{order_id}/items", response_model=List[OrderItemRead], dependencies=[Depends(query_budget(2))])
+async def get_order_items(order_id: int, db: AsyncSession = Depends(get_read_db)):
     """
     Retrieves the order items associated with a specific order.
 
+    The items are batch loaded with a single IN query and joined to their
+    products, so the cost does not grow with the number of lines.
+
     Args:
         order_id: The ID of the order to retrieve items for.
-        db: A database session dependency injected using `Depends(get_db)`.
+        db: A database session dependency injected using `Depends(get_async_db)`.
 
     Returns:
-        A list of order items, potentially including product details.
+        A list of order items, each including its product details.
 
     Raises:
         HTTPException: If the order with the provided ID is not found.
     """
-    order = db.query(Order).filter(Order.id == order_id).first()
+    order = await db.scalar(
+        select(Order)
+        .options(selectinload(Order.order_items).joinedload(OrderItem.product))
+        .where(Order.id == order_id)
+    )
     if order is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Order not found")
 
-    order_items = order.order_items
-
-    if Product:
-        for item in order_items:
-            product = db.query(Product).filter(Product.id == item.product_id).first()
-            item.product = product
-
-    return order_items
+    return order.order_items
@@ -0,0 +1,82 @@
+from fastapi import HTTPException, status
+
+from .models import Order
+
+# `sort` values accepted by the order list, mapped to (column ordered before the id, descending).
+ORDER_SORTS = {
+    "id": (None, False),
+    "-id": (None, True),
+    "order_date": (Order.order_date, False),
+    "-order_date": (Order.order_date, True),
+}
+
+# The filter and sort combinations of the order list, with the index serving each one, so pages
+# stay index scans on large tables. Filters are named by column, a date range counts as "order_date".
+ORDER_INDEXES = {
+    ((), "id"): "orders_pkey",
+    ((), "order_date"): "ix_orders_order_date_id",
+    (("status",), "id"): "ix_orders_status_id",
+    (("status",), "order_date"): "ix_orders_status_order_date_id",
+    (("order_date",), "order_date"): "ix_orders_order_date_id",
+    (("order_date", "status"), "order_date"): "ix_orders_status_order_date_id",
+    (("customer_name",), "id"): "ix_orders_customer_name",
+}
+
+
+def order_index(sort, order_status=None, order_date_from=None, order_date_to=None, customer_name=None):
+    """
+    The index serving an order list query, see `ORDER_INDEXES`.
+
+    Raises:
+        HTTPException: 422 for a combination no index serves.
+    """
+    filters = []
+    if customer_name:
+        filters.append("customer_name")
+    if order_date_from is not None or order_date_to is not None:
+        filters.append("order_date")
+    if order_status is not None:
+        filters.append("status")
+    index = ORDER_INDEXES.get((tuple(sorted(filters)), sort.lstrip("-")))
+    if index is None:
+        supported = [
+            " + ".join(names or ["no filter"]) + f", sort by {sort_key}" for names, sort_key in ORDER_INDEXES
+        ]
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Unsupported filters and sort, choose from {supported}",
+        )
+    return index
+
+
+def _prefix_pattern(text):
+    return text.replace("/", "//").replace("%", "/%").replace("_", "/_") + "%"
+
+
+def filter_orders(query, order_status=None, order_date_from=None, order_date_to=None, customer_name=None):
+    """
+    Filtering an order query, every filter left to None is skipped.
+
+    The combinations offered by the order list are served by the indexes of
+    `ORDER_INDEXES`. The customer name prefix uses a `varchar_pattern_ops`
+    index on PostgreSQL, so LIKE 'prefix%' can use it whatever the collation.
+
+    Args:
+        query: A select statement over `Order`.
+        order_status: Only the orders in this status.
+        order_date_from: Only the orders placed at or after this date.
+        order_date_to: Only the orders placed before this date.
+        customer_name: Only the orders whose customer name starts with this text (case sensitive).
+
+    Returns:
+        The filtered statement.
+    """
+    if order_status is not None:
+        query = query.where(Order.status == order_status)
+    if order_date_from is not None:
+        query = query.where(Order.order_date >= order_date_from)
+    if order_date_to is not None:
+        query = query.where(Order.order_date < order_date_to)
+    if customer_name:
+        query = query.where(Order.customer_name.like(_prefix_pattern(customer_name), escape="/"))
+    return query
@@ -1,9 +1,16 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Float, DateTime
+from sqlalchemy import Boolean, Column, Integer, String, ForeignKey, Float, DateTime, Date, Index, false
 from sqlalchemy.orm import relationship
 from datetime import datetime
 
 from custom_function import Base
 
+ORDER_STATUSES = ("pending", "fulfilled", "cancelled")
+
+
+def _reserves_stock(context):
+    return context.get_current_parameters()["status"] != "cancelled"
+
+
 class Order(Base):
     __tablename__ = "orders"
 
@@ -12,14 +19,45 @@ class Order(Base):
     customer_address = Column(String(255))
     order_date = Column(DateTime, default=datetime.now)
     status = Column(String, nullable=False)
+    # Sum of quantity * price and number of the order items, kept up to date by the order endpoints (see `Order.totals`).
+    total = Column(Float, nullable=False, server_default="0")
+    item_count = Column(Integer, nullable=False, server_default="0")
+    # Whether the stock of the items is held by the order, so cancelling or deleting it gives the stock back.
+    # Orders created before reservations existed never took stock and keep false.
+    stock_reserved = Column(Boolean, nullable=False, default=_reserves_stock, server_default=false())
     order_items = relationship("OrderItem", backref="order")
 
+    __table_args__ = (
+        # One index per filter and sort of the order list, see `Order.filters.filter_orders`.
+        Index("ix_orders_order_date_id", "order_date", "id"),
+        Index("ix_orders_status_id", "status", "id"),
+        Index("ix_orders_status_order_date_id", "status", "order_date", "id"),
+        Index("ix_orders_customer_name", "customer_name", postgresql_ops={"customer_name": "varchar_pattern_ops"}),
+    )
+
 
 class OrderItem(Base):
     __tablename__ = "order_items"
 
     id = Column(Integer, primary_key=True)
-    order_id = Column(Integer, ForeignKey("orders.id"))
-    product_id = Column(Integer, ForeignKey("products.id"))
+    order_id = Column(Integer, ForeignKey("orders.id"), index=True)
+    product_id = Column(Integer, ForeignKey("products.id"), index=True)
     quantity = Column(Integer)
     price = Column(Float)
+    product = relationship("Product")
+
+
+class OrderDailyStats(Base):
+    """
+    Order count and revenue per day and status, kept up to date by the order endpoints.
+
+    Each (day, status) is split over a few `shard` rows picked at random, so
+    concurrent orders do not all wait on the same counter row.
+    """
+    __tablename__ = "order_stats_daily"
+
+    day = Column(Date, primary_key=True)
+    status = Column(String, primary_key=True)
+    shard = Column(Integer, primary_key=True)
+    order_count = Column(Integer, nullable=False, default=0)
+    revenue = Column(Float, nullable=False, default=0)
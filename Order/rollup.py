@@ -0,0 +1,118 @@
+"""
+Incremental order analytics.
+
+The order endpoints add their changes to `order_stats_daily` in the same
+transaction as the order itself, so the stats endpoints never scan `orders`.
+For backfills or after manual edits, rebuild the table from scratch with
+
+    python -m Order.rollup
+"""
+import random
+
+from sqlalchemy import delete, func, insert, literal, select
+
+from custom_function import UPSERTS
+
+from .models import Order, OrderDailyStats, OrderItem
+
+ROLLUP_SHARDS = 8
+
+
+async def record(db, changes):
+    """
+    Adding order counts and revenue to the rollup.
+
+    Args:
+        db: An async database session, the caller commits.
+        changes: A mapping of `(day, status)` to `(order_count, revenue)` to add, negative to remove.
+    """
+    upsert = UPSERTS[db.bind.dialect.name]
+    for (day, status), (order_count, revenue) in sorted(changes.items()):
+        if day is None or (order_count == 0 and not revenue):
+            continue
+        stmt = upsert(OrderDailyStats).values(
+            day=day, status=status, shard=random.randrange(ROLLUP_SHARDS), order_count=order_count, revenue=revenue,
+        )
+        await db.execute(stmt.on_conflict_do_update(
+            index_elements=["day", "status", "shard"],
+            set_={
+                "order_count": OrderDailyStats.order_count + stmt.excluded.order_count,
+                "revenue": OrderDailyStats.revenue + stmt.excluded.revenue,
+            },
+        ))
+
+
+def counts_by_status(date_from=None, date_to=None):
+    query = select(OrderDailyStats.status, func.sum(OrderDailyStats.order_count).label("order_count"))
+    if date_from is not None:
+        query = query.where(OrderDailyStats.day >= date_from)
+    if date_to is not None:
+        query = query.where(OrderDailyStats.day <= date_to)
+    return (
+        query.group_by(OrderDailyStats.status)
+        .having(func.sum(OrderDailyStats.order_count) > 0)
+        .order_by(OrderDailyStats.status)
+    )
+
+
+def revenue_by_day(date_from=None, date_to=None):
+    query = (
+        select(
+            OrderDailyStats.day,
+            func.sum(OrderDailyStats.order_count).label("order_count"),
+            func.sum(OrderDailyStats.revenue).label("revenue"),
+        )
+        .where(OrderDailyStats.status != "cancelled")
+    )
+    if date_from is not None:
+        query = query.where(OrderDailyStats.day >= date_from)
+    if date_to is not None:
+        query = query.where(OrderDailyStats.day <= date_to)
+    return (
+        query.group_by(OrderDailyStats.day)
+        .having(func.sum(OrderDailyStats.order_count) > 0)
+        .order_by(OrderDailyStats.day)
+    )
+
+
+def rebuild(conn):
+    """
+    Recomputing the whole rollup from `orders` and `order_items`.
+
+    Args:
+        conn: A sync connection, the caller commits.
+
+    Returns:
+        The number of (day, status) rows written.
+    """
+    totals = (
+        select(OrderItem.order_id, func.sum(OrderItem.quantity * OrderItem.price).label("revenue"))
+        .group_by(OrderItem.order_id)
+        .subquery()
+    )
+    day = func.date(Order.order_date)
+    rows = (
+        select(
+            day,
+            Order.status,
+            literal(0),
+            func.count(Order.id),
+            func.coalesce(func.sum(totals.c.revenue), 0),
+        )
+        .outerjoin(totals, totals.c.order_id == Order.id)
+        .where(Order.order_date.is_not(None))
+        .group_by(day, Order.status)
+    )
+    conn.execute(delete(OrderDailyStats))
+    result = conn.execute(insert(OrderDailyStats).from_select(
+        ["day", "status", "shard", "order_count", "revenue"], rows,
+    ))
+    return result.rowcount
+
+
+if __name__ == "__main__":
+    import Product.models, Supplier.models, Warehouse.models  # noqa: F401, registers the related tables
+    from custom_function import engine
+
+    with engine.begin() as conn:
+        print(f"Rebuilt {rebuild(conn)} order stats rows")
@@ -1,8 +1,11 @@
-from pydantic import BaseModel
-from datetime import datetime
+from pydantic import BaseModel, ConfigDict, Field
+from datetime import date, datetime
+from typing import List, Optional, Union
+
+from Product.schema import ProductRead
 
 class StatusUpdate(BaseModel):
-    status: int
+    status: str
 
 
 class OrderCreate(BaseModel):
@@ -10,3 +13,66 @@ class OrderCreate(BaseModel):
     customer_address: str
     order_date: datetime
     status: str
+
+
+class OrderBulkCreate(OrderCreate):
+    # Bulk orders take no items, a row sending some is rejected rather than created without them and their stock.
+    model_config = ConfigDict(extra="forbid")
+
+
+class OrderUpdate(BaseModel):
+    # Only the fields sent are updated, null is refused for the required columns.
+    customer_name: str = None
+    customer_address: Optional[str] = None
+    order_date: datetime = None
+    status: str = None
+
+
+class OrderRead(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    # Everything but the id may be left out by a `fields` projection.
+    customer_name: Optional[str] = None
+    customer_address: Optional[str] = None
+    order_date: Optional[datetime] = None
+    status: Optional[str] = None
+    total: Optional[float] = None
+    item_count: Optional[int] = None
+
+
+class OrderPage(BaseModel):
+    items: List[OrderRead]
+    # An id when sorting by id, an opaque string otherwise.
+    next_cursor: Optional[Union[int, str]] = None
+
+
+class OrderItemCreate(BaseModel):
+    product_id: int
+    quantity: int = Field(gt=0)
+
+
+class OrderWithItemsCreate(OrderCreate):
+    items: List[OrderItemCreate] = []
+
+
+class OrderItemRead(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    order_id: int
+    product_id: Optional[int] = None
+    quantity: Optional[int] = None
+    price: Optional[float] = None
+    product: Optional[ProductRead] = None
+
+
+class StatusCount(BaseModel):
+    status: str
+    order_count: int
+
+
+class DailyRevenue(BaseModel):
+    day: date
+    order_count: int
+    revenue: float
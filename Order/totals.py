@@ -0,0 +1,112 @@
+"""
+Stored order totals.
+
+`orders.total` and `orders.item_count` are written by the order endpoints in
+the same transaction as the items, so listing orders never reads
+`order_items`. After a backfill or manual edits to `order_items`, check or fix
+them with
+
+    python -m Order.totals [--check]
+
+which walks `orders` by id range, one short transaction per batch.
+"""
+from sqlalchemy import func, or_, select, update
+
+from .models import Order, OrderItem
+
+REPAIR_BATCH_SIZE = 10000
+# Totals are float sums added up in a different order than the repair query, ignore rounding noise.
+TOTAL_TOLERANCE = 0.001
+
+
+async def add(db, order_id, total, item_count):
+    """
+    Adding to the stored totals of an order, negative values to remove.
+
+    Args:
+        db: An async database session, the caller commits.
+        order_id: The order whose items changed.
+        total: The change of the sum of quantity * price.
+        item_count: The change of the number of items.
+    """
+    await db.execute(
+        update(Order)
+        .where(Order.id == order_id)
+        .values(total=Order.total + total, item_count=Order.item_count + item_count)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def id_batches(conn, batch_size=REPAIR_BATCH_SIZE):
+    """
+    The `(start, stop)` id ranges covering `orders`, `batch_size` ids each.
+    """
+    first, last = conn.execute(select(func.min(Order.id), func.max(Order.id))).one()
+    if first is None:
+        return []
+    return [(start, start + batch_size) for start in range(first, last + 1, batch_size)]
+
+
+def repair_batch(conn, start, stop, fix=True):
+    """
+    Comparing the stored totals of the orders with ids in `[start, stop)` to their items.
+
+    Args:
+        conn: A sync connection, the caller commits.
+        start: First order id of the batch.
+        stop: Order id right after the batch.
+        fix: Overwrite the wrong totals, otherwise only count them.
+
+    Returns:
+        The number of orders whose stored totals were wrong.
+    """
+    items = select(OrderItem).where(OrderItem.order_id == Order.id)
+    total = (
+        items.with_only_columns(func.coalesce(func.sum(OrderItem.quantity * OrderItem.price), 0))
+        .scalar_subquery()
+    )
+    item_count = items.with_only_columns(func.count(OrderItem.id)).scalar_subquery()
+    drifted = (
+        Order.id >= start,
+        Order.id < stop,
+        or_(func.abs(Order.total - total) > TOTAL_TOLERANCE, Order.item_count != item_count),
+    )
+    if not fix:
+        return conn.scalar(select(func.count(Order.id)).where(*drifted))
+    return conn.execute(update(Order).where(*drifted).values(total=total, item_count=item_count)).rowcount
+
+
+def repair(bind, batch_size=REPAIR_BATCH_SIZE, fix=True):
+    """
+    Checking (and fixing) the stored totals of every order, one transaction per batch.
+
+    Args:
+        bind: A sync engine.
+        batch_size: Number of order ids per batch.
+        fix: Overwrite the wrong totals, otherwise only count them.
+
+    Returns:
+        The number of orders whose stored totals were wrong.
+    """
+    with bind.connect() as conn:
+        batches = id_batches(conn, batch_size)
+    drifted = 0
+    for start, stop in batches:
+        with bind.begin() as conn:
+            drifted += repair_batch(conn, start, stop, fix)
+    return drifted
+
+
+if __name__ == "__main__":
+    import argparse
+
+    import Product.models, Supplier.models, Warehouse.models  # noqa: F401, registers the related tables
+    from custom_function import engine
+
+    parser = argparse.ArgumentParser(description="Check and fix the stored order totals.")
+    parser.add_argument("--check", action="store_true", help="only report the wrong totals")
+    parser.add_argument("--batch-size", type=int, default=REPAIR_BATCH_SIZE)
+    args = parser.parse_args()
+
+    drifted = repair(engine, args.batch_size, fix=not args.check)
+    print(f"{drifted} orders had wrong totals" + ("" if args.check else ", fixed"))
@@ -1,31 +1,100 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from typing import Any, Dict, List
 
-from Supplier.models import Supplier
-from custom_function import get_db
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from sqlalchemy import delete, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from .schema import ProductCreate, StockUpdate
+from Supplier.models import Supplier
+from Warehouse.capacity import has_room, room_left
+from custom_function import (
+    DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, BulkResult, Message, bulk_insert, export_response, get_async_db, get_read_db,
+    paginate, select_fields, update_returning_previous,
+)
+from metrics import query_budget
+
+from .cache import product_cache
+from .schema import (
+    ProductCreate, ProductPage, ProductRead, ProductUpdate, StockAdjustment, StockAdjustmentResult, StockUpdate,
+)
+from .stock import adjust_stock_bulk
 from .models import Product
+from .search import search_products_query
 
 product_app = APIRouter()
 
-@product_app.get("/")
-async def get_all_products(db: Session = Depends(get_db)):
+
+def _warehouse_full(warehouse_id):
+    return HTTPException(
+        status_code=status.HTTP_409_CONFLICT, detail=f"Not enough capacity left in warehouse {warehouse_id}",
+    )
+
+
+async def _check_room(db, product):
+    """
+    Rolling back an update that added stock to a warehouse without room for it.
+
+    Args:
+        product: The row returned by `update_returning_previous`, with the previous stock and warehouse_id.
+    """
+    moved = product["warehouse_id"] != product["previous_warehouse_id"]
+    if not moved and (product["stock"] or 0) <= (product["previous_stock"] or 0):
+        return
+    if not await has_room(db, product["warehouse_id"], product["stock"], product["id"]):
+        await db.rollback()
+        raise _warehouse_full(product["warehouse_id"])
+
+
+@product_app.get(
+    "/", response_model=ProductPage, response_model_exclude_unset=True, dependencies=[Depends(query_budget(1))],
+)
+async def get_all_products(
+    after: int = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    fields: str = None,
+    db: AsyncSession = Depends(get_read_db),
+):
     """
-    Retrieving all products
+    Retrieving products one page at a time, ordered by id.
 
     Args:
+        after: The `next_cursor` of the previous page, omit it for the first page.
+        limit: Maximum number of products in the page.
+        fields: Comma separated product fields to return (e.g. `id,name,price`), all of them when omitted.
         db: A database session dependency (fixture) for database access.
     
     Returns:
-         A list of JSON objects containing the product data else en empty list.
+         A JSON object with the page `items` and the `next_cursor` (null on the last page).
     """
-    products = db.query(Product).all()
-    return products
+    return await paginate(db, select(*select_fields(Product, fields)), Product.id, after, limit)
 
 
-@product_app.post("/")
-async def create_product(product: ProductCreate, db: Session = Depends(get_db)):
+@product_app.get("/export", dependencies=[Depends(query_budget(1))])
+async def export_products(
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    supplier_id: int = None,
+    warehouse_id: int = None,
+):
+    """
+    Exporting products as a stream, for bulk consumers like BI pulls.
+
+    Args:
+        format: "ndjson" (default) or "csv".
+        supplier_id: Only export the products of this supplier.
+        warehouse_id: Only export the products stored in this warehouse.
+
+    Returns:
+        A streamed NDJSON or CSV file with one product per line.
+    """
+    query = select(*Product.__table__.columns).order_by(Product.id)
+    if supplier_id is not None:
+        query = query.where(Product.supplier_id == supplier_id)
+    if warehouse_id is not None:
+        query = query.where(Product.warehouse_id == warehouse_id)
+    return export_response(query, format, "products")
+
+
+@product_app.post("/", response_model=ProductRead, dependencies=[Depends(query_budget(3))])
+async def create_product(product: ProductCreate, db: AsyncSession = Depends(get_async_db)):
     """
     Creating an product.
 
@@ -35,61 +104,127 @@ async def create_product(product: ProductCreate, db: Session = Depends(get_db)):
 
     Returns:
             A JSON of new created product data.
+
+    Raises:
+        HTTPException: 409 if its stock does not fit in the warehouse.
     """
-    new_product = Product(**product.dict())
-    db.add(new_product)
-    db.commit()
-    db.refresh(new_product)  # Refresh to get the generated ID
+    if not await has_room(db, product.warehouse_id, product.stock):
+        raise _warehouse_full(product.warehouse_id)
+    new_product = await db.scalar(insert(Product).values(**product.model_dump()).returning(Product))
+    await db.commit()
     return new_product
 
 
-@product_app.get("/{product_id}")
-async def get_product_by_id(product_id: int, db: Session = Depends(get_db)):
+@product_app.post("/bulk", response_model=BulkResult, dependencies=[Depends(query_budget(allow_repeats=True))])
+async def create_products_bulk(products: List[Dict[str, Any]], db: AsyncSession = Depends(get_async_db)):
+    """
+    Creating many products in one request.
+
+    The warehouses the products go to are locked first, products whose stock
+    does not fit in the room left are rejected like invalid rows.
+
+    Args:
+        products: A JSON list of (`ProductCreate`) objects.
+        db: A database session dependency (fixture) for database access.
+
+    Returns:
+        A JSON object with the `created` products (request index and id) and the
+        `errors` of the rows that were rejected.
+    """
+    warehouse_ids = set()
+    for row in products:
+        try:
+            warehouse_ids.add(int(row["warehouse_id"]))
+        except (KeyError, TypeError, ValueError):
+            continue
+    room = await room_left(db, warehouse_ids)
+
+    def check(product):
+        if product.warehouse_id not in room:
+            return None
+        if product.stock > room[product.warehouse_id]:
+            return f"Not enough capacity left in warehouse {product.warehouse_id}"
+        room[product.warehouse_id] -= product.stock
+
+    return await bulk_insert(db, Product, ProductCreate, products, check=check)
+
+
+@product_app.get(
+    "/{product_id}", response_model=ProductRead, response_model_exclude_unset=True,
+    dependencies=[Depends(query_budget(1))],
+)
+async def get_product_by_id(product_id: int, fields: str = None, db: AsyncSession = Depends(get_async_db)):
     """
-    Retrieving an product by its ID.
+    Retrieving an product by its ID, served from the product cache when possible.
+
+    Only full products are cached, a `fields` projection missing the cache
+    reads just those columns.
 
     Args:
         product_id: An ID for which the product has to be search.
+        fields: Comma separated product fields to return, all of them when omitted.
         db: A database session dependency (fixture) for database access.
     
     Returns:
-             A JSON object containing the product data if found, or an error message if not found.
+             A JSON object containing the product data.
+
+    Raises:
+        HTTPException: If the product with the provided ID is not found.
     """
-    product = db.query(Product).filter(Product.id == product_id).first()
+    columns = select_fields(Product, fields)
+    cached = await product_cache.get(product_id)
+    if cached is not None:
+        return {column.key: cached[column.key] for column in columns}
+
+    # Taken before reading, a write committing and evicting meanwhile keeps the row read out of the cache.
+    generation = await product_cache.generation(product_id)
+    product = (await db.execute(select(*columns).where(Product.id == product_id))).mappings().first()
     if product is None:
-        return {"message": "Product not found"}  # Handle non-existent product
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Product not found")
+
+    product = dict(product)
+    if not fields:
+        await product_cache.set(product_id, product, generation)
     return product
 
 
-@product_app.put("/{product_id}")
-async def update_product(product_id: int, product_update: ProductCreate = None, db: Session = Depends(get_db)):
+@product_app.put("/{product_id}", response_model=Message, dependencies=[Depends(query_budget(4))])
+async def update_product(product_id: int, product_update: ProductUpdate = None, db: AsyncSession = Depends(get_async_db)):
     """
     Updates an existing product in the database.
 
-    This function takes an optional JSON object representing product updates (`ProductCreate`) and modifies the corresponding product record in the database.
+    Only the fields present in the JSON body (`ProductUpdate`) are changed, with a single UPDATE.
 
     Args:
         product_id: The ID of the product to update.
         product_update: A JSON object containing updated product data (optional).
-        db: A database session dependency injected using `Depends(get_db)`.
+        db: A database session dependency injected using `Depends(get_async_db)`.
 
     Returns:
         A JSON message indicating successful update.
+
+    Raises:
+        HTTPException: 404 if the product does not exist, 409 if its stock does not fit in the warehouse.
     """
-    product = db.query(Product).filter(Product.id == product_id).first()
+    values = product_update.model_dump(exclude_unset=True) if product_update else {}
+    if not values:
+        if await db.scalar(select(Product.id).where(Product.id == product_id)) is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Product not found")
+        return {"message": 'Updated'}
+
+    product = await update_returning_previous(
+        db, Product, product_id, values, [Product.stock, Product.warehouse_id],
+    )
     if product is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Product not found")
-
-    if product_update:
-        for field, value in product_update.dict().items():
-            if value is not None:
-                setattr(product, field, value)
-    db.commit()
+    await _check_room(db, product)
+    await db.commit()
+    await product_cache.delete(product_id)
     return {"message": 'Updated'}
 
 
-@product_app.delete("/{product_id}")
-async def delete_product(product_id: int, db: Session = Depends(get_db)):
+@product_app.delete("/{product_id}", response_model=Message, dependencies=[Depends(query_budget(1))])
+async def delete_product(product_id: int, db: AsyncSession = Depends(get_async_db)):
     """
     Deletes a product from the database.
 
@@ -97,49 +232,62 @@ async def delete_product(product_id: int, db: Session = Depends(get_db)):
 
     Args:
         product_id: The ID of the product to delete.
-        db: A database session dependency injected using `Depends(get_db)`.
+        db: A database session dependency injected using `Depends(get_async_db)`.
 
     Returns:
         A JSON message indicating successful deletion.
     """
-    product = db.query(Product).filter(Product.id == product_id).first()
-
-    if product is None:
+    deleted = await db.scalar(delete(Product).where(Product.id == product_id).returning(Product.id))
+    if deleted is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Product not found")
-    db.delete(product)
-    db.commit()
+    await db.commit()
+    await product_cache.delete(product_id)
     return {"message": "Product deleted successfully"}
 
 
-@product_app.get("/search/")
-async def search_products(name: str = None, supplier_name: str = None, db: Session = Depends(get_db)):
+@product_app.get(
+    "/search/", response_model=List[ProductRead], response_model_exclude_unset=True,
+    dependencies=[Depends(query_budget(1))],
+)
+async def search_products(
+    name: str = None,
+    supplier_name: str = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    offset: int = Query(0, ge=0),
+    fields: str = None,
+    db: AsyncSession = Depends(get_read_db),
+):
     """
     Search product with name and supplier_name.
 
+    The text in `name` is matched against product names and descriptions and
+    results are ordered by relevance. The supplier is resolved in the same query.
+
     Args:
-        name: Product Name for which have to search
+        name: Text to look for in the product name or description
         supplier_name: Supplier name related to product
+        limit: Maximum number of products returned.
+        offset: Number of ranked products to skip.
+        fields: Comma separated product fields to return, all of them when omitted.
         db: A database session dependency (fixture) for database access.
 
     Returns:
-        A JSON response if product found else a message with not found.
+        A JSON list of matching products, best matches first, else an empty list.
     """
-    query = db.query(Product)
-    if name:
-        query = query.filter(Product.name.ilike(f"%{name}%"))
-
+    query = select(*select_fields(Product, fields))
     if supplier_name:
-        supplier_id = db.query(Supplier).filter(Supplier.name == supplier_name).first()
-        if supplier_id:
-            query = query.filter(Product.supplier_id == supplier_id.id)
-        else:
-            return []
+        query = query.join(Supplier, Supplier.id == Product.supplier_id).where(Supplier.name == supplier_name)
+
+    if name:
+        query = search_products_query(query, name, db.bind.dialect.name)
+    else:
+        query = query.order_by(Product.id)
 
-    products = query.all()
+    products = (await db.execute(query.limit(limit).offset(offset))).mappings().all()
     return products
 
-@product_app.patch("/{product_id}/stock")
-async def update_product_stock(product_id: int, stock_update: StockUpdate, db: Session = Depends(get_db)):
+@product_app.patch("/{product_id}/stock", response_model=Message, dependencies=[Depends(query_budget(4))])
+async def update_product_stock(product_id: int, stock_update: StockUpdate, db: AsyncSession = Depends(get_async_db)):
     """
     Updating product stock with a valid status.
 
@@ -149,10 +297,67 @@ async def update_product_stock(product_id: int, stock_update: StockUpdate, db: S
 
     Returns:
         A JSON message indicating stock is updated or not.
+
+    Raises:
+        HTTPException: 404 if the product does not exist, 409 if the new stock does not fit in the warehouse.
     """
-    product = db.query(Product).filter(Product.id == product_id).first()
+    product = await update_returning_previous(
+        db, Product, product_id, {"stock": stock_update.stock}, [Product.stock, Product.warehouse_id],
+    )
     if product is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Product not found")
-    product.stock = stock_update.stock
-    db.commit()
+    await _check_room(db, product)
+    await db.commit()
+    await product_cache.delete(product_id)
     return {"message": "Product stock updated successfully"}
+
+
+@product_app.patch("/stock", response_model=StockAdjustmentResult, dependencies=[Depends(query_budget(4))])
+async def update_products_stock_bulk(adjustments: List[StockAdjustment], db: AsyncSession = Depends(get_async_db)):
+    """
+    Updating the stock of many products at once, for inventory feeds.
+
+    Each line either sets the `stock` or adds a `delta` to it. Lines for the
+    same product are combined in order. Everything is applied in one
+    transaction with a single UPDATE, products whose stock would go negative
+    are left unchanged. The whole feed is refused when it puts a warehouse
+    over its capacity.
+
+    Args:
+        adjustments: A JSON list of (`StockAdjustment`) objects.
+        db: A database session dependency (fixture) for database access.
+
+    Returns:
+        A JSON object with the number of updated products, the ids that do not
+        exist and the ids rejected for going negative.
+
+    Raises:
+        HTTPException: 409 if a warehouse receiving stock would go over its capacity.
+    """
+    changes = {}
+    for adjustment in adjustments:
+        stock, delta = changes.get(adjustment.product_id, (None, 0))
+        if adjustment.stock is not None:
+            stock, delta = adjustment.stock, 0
+        else:
+            delta += adjustment.delta
+        changes[adjustment.product_id] = (stock, delta)
+
+    updated, rejected = await adjust_stock_bulk(db, changes) if changes else ({}, [])
+    # Products are locked by the update, the warehouses after them, in the same order as `_check_room`.
+    growth = {}
+    for warehouse_id, previous, stock in updated.values():
+        growth[warehouse_id] = growth.get(warehouse_id, 0) + (stock or 0) - (previous or 0)
+    room = await room_left(db, [warehouse_id for warehouse_id, grown in growth.items() if grown > 0])
+    full = sorted(warehouse_id for warehouse_id, left in room.items() if left < 0)
+    if full:
+        await db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT, detail=f"Not enough capacity left in warehouses {full}",
+        )
+    await db.commit()
+    for product_id in updated:
+        await product_cache.delete(product_id)
+
+    missing = sorted(set(changes) - set(updated) - set(rejected))
+    return {"updated": len(updated), "missing": missing, "rejected": rejected}
@@ -0,0 +1,9 @@
+import os
+
+from cache import LRUCache
+
+# Product details keyed by product id, as returned by `get_product_by_id`.
+product_cache = LRUCache(
+    maxsize=int(os.getenv("product_cache_size", 10000)),
+    ttl=float(os.getenv("product_cache_ttl", 60)),
+)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Float
+from sqlalchemy import DDL, Column, Integer, String, ForeignKey, Float, Index, event
 from custom_function import Base
 
 class Product(Base):
@@ -8,6 +8,27 @@ class Product(Base):
     name = Column(String(255), nullable=False)
     description = Column(String(255))
     price = Column(Float)
-    supplier_id = Column(Integer, ForeignKey("suppliers.id"))
+    supplier_id = Column(Integer, ForeignKey("suppliers.id"), index=True)
     stock = Column(Integer)
     warehouse_id = Column(Integer, ForeignKey("warehouses.id"))
+
+    __table_args__ = (
+        # Serves the warehouse_id foreign key and covers the per-warehouse stock sums of the capacity checks.
+        Index("ix_products_warehouse_id_stock", "warehouse_id", "stock"),
+        # Trigram indexes serve the ILIKE '%text%' filters of the product search.
+        Index(
+            "ix_products_name_trgm", "name",
+            postgresql_using="gin", postgresql_ops={"name": "gin_trgm_ops"},
+        ).ddl_if(dialect="postgresql"),
+        Index(
+            "ix_products_description_trgm", "description",
+            postgresql_using="gin", postgresql_ops={"description": "gin_trgm_ops"},
+        ).ddl_if(dialect="postgresql"),
+    )
+
+
+event.listen(
+    Product.__table__,
+    "before_create",
+    DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect="postgresql"),
+)
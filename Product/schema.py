@@ -1,4 +1,5 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, model_validator
+from typing import List, Optional
 
 class ProductCreate(BaseModel):
     name: str
@@ -9,5 +10,52 @@ class ProductCreate(BaseModel):
     warehouse_id: int
 
 
+class ProductUpdate(BaseModel):
+    # Only the fields sent are updated, null is refused for the required columns.
+    name: str = None
+    description: Optional[str] = None
+    price: float = None
+    supplier_id: int = None
+    stock: int = None
+    warehouse_id: int = None
+
+
+class ProductRead(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    # Everything but the id may be left out by a `fields` projection.
+    name: Optional[str] = None
+    description: Optional[str] = None
+    price: Optional[float] = None
+    supplier_id: Optional[int] = None
+    stock: Optional[int] = None
+    warehouse_id: Optional[int] = None
+
+
+class ProductPage(BaseModel):
+    items: List[ProductRead]
+    next_cursor: Optional[int] = None
+
+
 class StockUpdate(BaseModel):
     stock: int
+
+
+class StockAdjustment(BaseModel):
+    product_id: int
+    stock: Optional[int] = None
+    delta: Optional[int] = None
+
+    @model_validator(mode="after")
+    def check_stock_or_delta(self):
+        if (self.stock is None) == (self.delta is None):
+            raise ValueError("give either stock or delta")
+        return self
+
+
+class StockAdjustmentResult(BaseModel):
+    updated: int
+    missing: List[int]
+    # Products left unchanged because their stock would have gone negative.
+    rejected: List[int] = []
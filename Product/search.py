@@ -0,0 +1,45 @@
+from sqlalchemy import case, func, or_
+
+from .models import Product
+
+
+def _like_pattern(text):
+    escaped = text.replace("/", "//").replace("%", "/%").replace("_", "/_")
+    return f"%{escaped}%"
+
+
+def search_products_query(query, text, dialect_name):
+    """
+    Filtering and ranking a product query by a free text search on name and description.
+
+    On PostgreSQL the ILIKE filters are served by the pg_trgm GIN indexes on
+    `products` and results are ranked by trigram similarity. Other databases
+    (SQLite for local testing) fall back to plain LIKE with a coarse ranking
+    that puts name matches before description matches.
+
+    Args:
+        query: A select statement over `Product`.
+        text: The text typed by the user.
+        dialect_name: Name of the database dialect the query will run on.
+
+    Returns:
+        The statement filtered by the text and ordered by relevance.
+    """
+    pattern = _like_pattern(text)
+    query = query.where(
+        or_(Product.name.ilike(pattern, escape="/"), Product.description.ilike(pattern, escape="/"))
+    )
+
+    if dialect_name == "postgresql":
+        rank = func.greatest(
+            func.similarity(Product.name, text),
+            func.similarity(func.coalesce(Product.description, ""), text) * 0.5,
+        )
+    else:
+        rank = case(
+            (func.lower(Product.name) == text.lower(), 3),
+            (Product.name.ilike(pattern[1:], escape="/"), 2),
+            (Product.name.ilike(pattern, escape="/"), 1),
+            else_=0,
+        )
+    return query.order_by(rank.desc(), Product.id)
@@ -0,0 +1,167 @@
+from sqlalchemy import Integer, any_, bindparam, func, select, update
+from sqlalchemy.dialects.postgresql import ARRAY
+
+from .models import Product
+
+
+async def reserve_stock(db, quantities):
+    """
+    Taking stock for an order with one conditional UPDATE per product.
+
+    Each statement only succeeds while enough stock is left, so concurrent
+    orders never oversell and a row lock is held just for that statement
+    until the caller commits. Products are updated in id order so two
+    transactions reserving the same products cannot deadlock.
+
+    Args:
+        db: An async database session, the caller commits or rolls back.
+        quantities: A mapping of product id to the quantity to reserve.
+
+    Returns:
+        The id of the first product without enough stock, or None when everything was reserved.
+    """
+    for product_id in sorted(quantities):
+        quantity = quantities[product_id]
+        reserved = await db.scalar(
+            update(Product)
+            .where(Product.id == product_id, Product.stock >= quantity)
+            .values(stock=Product.stock - quantity)
+            .returning(Product.id)
+            .execution_options(synchronize_session=False)
+        )
+        if reserved is None:
+            return product_id
+    return None
+
+
+async def reserve_stock_lines(db, lines, product_ids):
+    """
+    Taking stock for many order lines with one set-based conditional UPDATE.
+
+    The quantities of the `lines` are added up per product and joined to the
+    products with `UPDATE ... FROM`, which only takes the stock of products
+    that have enough, so a request costs the same statements whatever its
+    size. On PostgreSQL the products are first locked in id order, like
+    `reserve_stock` does, so concurrent reservations cannot deadlock.
+
+    Args:
+        db: An async database session, the caller commits or rolls back.
+        lines: A selectable of `(product_id, quantity)` rows, e.g. the unnested request lines.
+        product_ids: The ids of the products in `lines`.
+
+    Returns:
+        The id of the first product without enough stock, or None when everything was reserved.
+    """
+    wanted = (
+        select(lines.c.product_id, func.sum(lines.c.quantity).label("quantity"))
+        .group_by(lines.c.product_id)
+        .subquery("wanted")
+    )
+    if db.bind.dialect.name == "postgresql":
+        await db.execute(
+            select(Product.id)
+            .where(Product.id.in_(select(wanted.c.product_id)))
+            .order_by(Product.id)
+            .with_for_update()
+        )
+    reserved = set(await db.scalars(
+        update(Product)
+        .where(Product.id == wanted.c.product_id, Product.stock >= wanted.c.quantity)
+        .values(stock=Product.stock - wanted.c.quantity)
+        .returning(Product.id)
+        .execution_options(synchronize_session=False)
+    ))
+    short = sorted(set(product_ids) - reserved)
+    return short[0] if short else None
+
+
+async def release_stock(db, quantities):
+    """
+    Giving back the stock reserved by an order, in product id order.
+
+    Warehouse capacity is not checked: an order must always be cancellable,
+    so this may take a warehouse over its capacity (see `Warehouse.capacity.has_room`).
+
+    Args:
+        db: An async database session, the caller commits or rolls back.
+        quantities: A mapping of product id to the quantity to release.
+    """
+    for product_id in sorted(quantities):
+        await db.execute(
+            update(Product)
+            .where(Product.id == product_id)
+            .values(stock=Product.stock + quantities[product_id])
+            .execution_options(synchronize_session=False)
+        )
+
+
+async def adjust_stock_bulk(db, adjustments):
+    """
+    Applying many stock changes with one set-based UPDATE.
+
+    On PostgreSQL the products are first locked in id order, like
+    `reserve_stock` and `release_stock` do, so a large feed cannot deadlock
+    with concurrent orders. Then the whole batch is sent as three arrays and
+    joined with `UPDATE ... FROM unnest(...)`, so a batch costs two statements
+    whatever its size. Other databases (SQLite for local testing) read the
+    current stock and run the update as an executemany.
+
+    A missing (NULL) current stock counts as 0. Changes that would leave a
+    product with negative stock are not applied.
+
+    Args:
+        db: An async database session, the caller commits.
+        adjustments: A mapping of product id to `(stock, delta)`; the new stock
+            is `stock` (or the current one when None) plus `delta`.
+
+    Returns:
+        The updated products as `{product_id: (warehouse_id, previous stock, new stock)}`,
+        and the ids of those rejected because their stock would go negative.
+    """
+    ids = sorted(adjustments)
+    stocks = [adjustments[product_id][0] for product_id in ids]
+    deltas = [adjustments[product_id][1] for product_id in ids]
+
+    if db.bind.dialect.name == "postgresql":
+        current = {row.id: row for row in await db.execute(
+            select(Product.id, Product.stock, Product.warehouse_id)
+            .where(Product.id == any_(bindparam("lock_ids", ids, type_=ARRAY(Integer))))
+            .order_by(Product.id)
+            .with_for_update()
+        )}
+        values = func.unnest(
+            bindparam("ids", ids, type_=ARRAY(Integer)),
+            bindparam("stocks", stocks, type_=ARRAY(Integer)),
+            bindparam("deltas", deltas, type_=ARRAY(Integer)),
+        ).table_valued("id", "stock", "delta").render_derived(name="v")
+        new_stock = func.coalesce(values.c.stock, func.coalesce(Product.stock, 0)) + values.c.delta
+        new_stocks = dict((await db.execute(
+            update(Product)
+            .where(Product.id == values.c.id, new_stock >= 0)
+            .values(stock=new_stock)
+            .returning(Product.id, Product.stock)
+            .execution_options(synchronize_session=False)
+        )).all())
+    else:
+        current = {row.id: row for row in await db.execute(
+            select(Product.id, Product.stock, Product.warehouse_id).where(Product.id.in_(ids))
+        )}
+        new_stocks = {}
+        for product_id, row in current.items():
+            stock, delta = adjustments[product_id]
+            new_stock = ((row.stock or 0) if stock is None else stock) + delta
+            if new_stock >= 0:
+                new_stocks[product_id] = new_stock
+        if new_stocks:
+            await db.execute(
+                update(Product.__table__)
+                .where(Product.id == bindparam("product_id"))
+                .values(stock=bindparam("new_stock")),
+                [{"product_id": product_id, "new_stock": stock} for product_id, stock in new_stocks.items()],
+            )
+
+    updated = {
+        product_id: (current[product_id].warehouse_id, current[product_id].stock, stock)
+        for product_id, stock in new_stocks.items()
+    }
+    return updated, sorted(set(current) - set(updated))
@@ -1,17 +1,24 @@
+from typing import Any, Dict, List
+
 from fastapi import Depends, APIRouter
-from sqlalchemy.orm import Session
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from custom_function import get_db
+from custom_function import BulkResult, bulk_insert, get_async_db
+from metrics import query_budget
 
-from .schema import SupplierCreate
+from .schema import SupplierCreate, SupplierRead
 from .models import Supplier 
 
 supplier_app = APIRouter()
 
-@supplier_app.post("/")
-async def create_supplier(supplier: SupplierCreate, db: Session = Depends(get_db)):
-    new_supplier = Supplier(**supplier.dict())
-    db.add(new_supplier)
-    db.commit()
-    db.refresh(new_supplier)
+@supplier_app.post("/", response_model=SupplierRead, dependencies=[Depends(query_budget(1))])
+async def create_supplier(supplier: SupplierCreate, db: AsyncSession = Depends(get_async_db)):
+    new_supplier = await db.scalar(insert(Supplier).values(**supplier.model_dump()).returning(Supplier))
+    await db.commit()
     return new_supplier
+
+
+@supplier_app.post("/bulk", response_model=BulkResult, dependencies=[Depends(query_budget(allow_repeats=True))])
+async def create_suppliers_bulk(suppliers: List[Dict[str, Any]], db: AsyncSession = Depends(get_async_db)):
+    return await bulk_insert(db, Supplier, SupplierCreate, suppliers)
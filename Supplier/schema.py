@@ -1,5 +1,14 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
+from typing import Optional
 
 class SupplierCreate(BaseModel):
     name: str
     contact_info: str
+
+
+class SupplierRead(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    name: str
+    contact_info: Optional[str] = None
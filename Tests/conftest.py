@@ -0,0 +1,42 @@
+from contextlib import contextmanager
+
+import pytest
+
+from custom_function import async_engine, engine, replica_engines
+from metrics import count_queries
+from migrations import migrate
+
+
+@pytest.fixture(scope="session", autouse=True)
+def schema():
+    """
+    Bringing the test database schema up to date, as the application does at startup.
+    """
+    migrate(engine)
+
+
+@pytest.fixture
+def assert_max_queries():
+    """
+    Asserting how many statements the requests made inside the block may run.
+
+    Usage:
+        with assert_max_queries(2):
+            test_client.get("/1/items")
+
+    Fails listing the statements when the budget is exceeded, or when the same
+    statement ran several times (a likely N+1).
+    """
+
+    @contextmanager
+    def check(limit, allow_repeats=False):
+        # Reads may be served by a replica, count the statements of every engine.
+        with count_queries(*(counted.sync_engine for counted in (async_engine, *replica_engines))) as counter:
+            yield counter
+        statements = "\n".join(counter.statements)
+        assert counter.count <= limit, f"{counter.count} queries over the budget of {limit}:\n{statements}"
+        if not allow_repeats:
+            repeated = {statement: count for statement, count in counter.repeats.items() if count > 1}
+            assert not repeated, f"Likely N+1, statements repeated: {repeated}"
+
+    return check
@@ -0,0 +1,116 @@
+import asyncio
+
+import pytest
+
+import admission
+from admission import AdmissionMiddleware, Limiter, configure_limiters, parse_limits
+
+
+def test_limiter_queues_then_sheds():
+    """
+    With one slot and one queue place, the second request waits for the first and the third is shed.
+    """
+
+    async def scenario():
+        limiter = Limiter(concurrency=1, queue_depth=1)
+        assert await limiter.acquire(timeout=1)
+        queued = asyncio.create_task(limiter.acquire(timeout=1))
+        await asyncio.sleep(0)
+        assert not await limiter.acquire(timeout=1)
+        limiter.release()
+        assert await queued
+        limiter.release()
+        return limiter.stats()
+
+    stats = asyncio.run(scenario())
+    assert stats["active"] == 0 and stats["queued"] == 0 and stats["shed"] == 1
+
+
+def test_limiter_sheds_after_queue_timeout():
+    """
+    A queued request is shed once it has waited the queue timeout.
+    """
+
+    async def scenario():
+        limiter = Limiter(concurrency=1, queue_depth=1)
+        await limiter.acquire()
+        admitted = await limiter.acquire(timeout=0.01)
+        limiter.release()
+        return admitted, limiter.stats()
+
+    admitted, stats = asyncio.run(scenario())
+    assert not admitted
+    assert stats["active"] == 0 and stats["queued"] == 0 and stats["shed"] == 1
+
+
+def test_limiter_keeps_slot_released_as_the_queue_times_out(monkeypatch):
+    """
+    A slot handed over by `release` in the same tick as the queue timeout is kept, not leaked.
+    """
+    limiter = Limiter(concurrency=1, queue_depth=1)
+
+    async def wait_for_racing_release(waiter, timeout):
+        limiter.release()
+        raise asyncio.TimeoutError
+
+    async def scenario():
+        await limiter.acquire()
+        monkeypatch.setattr(admission.asyncio, "wait_for", wait_for_racing_release)
+        admitted = await limiter.acquire(timeout=1)
+        monkeypatch.undo()
+        active = limiter.stats()["active"]
+        limiter.release()
+        return admitted, active, limiter.stats()
+
+    admitted, active, stats = asyncio.run(scenario())
+    assert admitted and active == 1
+    assert stats["active"] == 0 and stats["queued"] == 0 and stats["shed"] == 0
+
+
+def test_requests_over_the_limit_get_503(monkeypatch):
+    """
+    Requests beyond the concurrency and queue limits are answered 503 with a Retry-After header.
+    """
+
+    async def slow_app(scope, receive, send):
+        await asyncio.sleep(0.05)
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    middleware = AdmissionMiddleware(slow_app, routers=("/orders",))
+    monkeypatch.setitem(admission.limiters, ("/orders", "write"), Limiter(concurrency=1, queue_depth=0))
+    responses = []
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            responses.append((message["status"], dict(message["headers"]).get(b"retry-after")))
+
+    async def scenario():
+        scope = {"type": "http", "method": "POST", "path": "/orders/"}
+        await asyncio.gather(middleware(scope, None, send), middleware(scope, None, send))
+
+    asyncio.run(scenario())
+    assert sorted(status for status, _ in responses) == [200, 503]
+    assert dict(responses)[503] == b"1"
+
+
+def test_parse_limits():
+    """
+    Reading `admission_limits`, malformed entries are rejected.
+    """
+    assert parse_limits("/orders:write=4:16, /product:read=8:64") == {
+        ("/orders", "write"): (4, 16),
+        ("/product", "read"): (8, 64),
+    }
+    with pytest.raises(ValueError):
+        parse_limits("/orders:delete=4:16")
+
+
+def test_only_listed_routers_are_limited():
+    """
+    Without `admission_limits` nothing is shed, entries for routers that are not served are ignored.
+    """
+    assert configure_limiters(("/orders", "/product")) == {}
+    limiters = configure_limiters(("/orders", "/product"), "/orders:write=4:16, /unknown:read=1:1")
+    assert list(limiters) == [("/orders", "write")]
+    assert limiters[("/orders", "write")].stats()["concurrency"] == 4
@@ -0,0 +1,44 @@
+import uuid
+
+import pytest
+from fastapi.testclient import TestClient
+
+from main import app
+
+
+@pytest.fixture
+def test_client() -> TestClient:
+    with TestClient(app) as client:
+        yield client
+
+
+def test_create_supplier_replayed(test_client: TestClient):
+    """
+    Retrying a create with the same Idempotency-Key returns the first response without creating again.
+
+    Args:
+        test_client: A TestClient instance for making API requests.
+    """
+    headers = {"Idempotency-Key": str(uuid.uuid4())}
+    supplier_data = {"name": "Retried Supplier", "contact_info": "retry@example.com"}
+    first = test_client.post("/supplier/", json=supplier_data, headers=headers)
+    retry = test_client.post("/supplier/", json=supplier_data, headers=headers)
+    assert first.status_code == retry.status_code == 200
+    assert retry.json()["id"] == first.json()["id"]
+    assert retry.headers["idempotent-replayed"] == "true"
+
+
+def test_idempotency_key_reused_with_other_body(test_client: TestClient):
+    """
+    Reusing an Idempotency-Key with a different request body is rejected.
+
+    Args:
+        test_client: A TestClient instance for making API requests.
+
+    Returns:
+        A JSON error with status code 422 (Unprocessable Entity).
+    """
+    headers = {"Idempotency-Key": str(uuid.uuid4())}
+    test_client.post("/supplier/", json={"name": "First", "contact_info": "x"}, headers=headers)
+    response = test_client.post("/supplier/", json={"name": "Second", "contact_info": "x"}, headers=headers)
+    assert response.status_code == 422
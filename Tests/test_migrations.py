@@ -0,0 +1,85 @@
+from sqlalchemy import create_engine, delete, insert, inspect, select, text
+
+import idempotency  # noqa: F401, registers the idempotency keys table
+from custom_function import Base
+from migrations import MIGRATIONS, migrate, schema_migrations
+from Order.models import Order, OrderItem
+
+
+def test_migrations_apply_once():
+    """
+    Migrating an empty database applies every migration, migrating again applies none.
+
+    Uses its own in-memory SQLite database.
+    """
+    engine = create_engine("sqlite://")
+    assert migrate(engine) == [version for version, _, _ in sorted(MIGRATIONS)]
+    assert migrate(engine) == []
+
+    indexes = {index["name"] for index in inspect(engine).get_indexes("orders")}
+    assert {"ix_orders_order_date_id", "ix_orders_status_order_date_id", "ix_orders_customer_name"} <= indexes
+
+
+def _schema(engine):
+    inspector = inspect(engine)
+    return {
+        table: (
+            sorted(column["name"] for column in inspector.get_columns(table)),
+            sorted(index["name"] for index in inspector.get_indexes(table)),
+        )
+        for table in inspector.get_table_names()
+    }
+
+
+def test_migrations_build_the_models_schema():
+    """
+    Migrating an empty database gives the tables, columns and indexes of the models.
+
+    The migrations spell out their own DDL, a model change without its migration fails here.
+    Uses its own in-memory SQLite databases.
+    """
+    migrated, created = create_engine("sqlite://"), create_engine("sqlite://")
+    migrate(migrated)
+    Base.metadata.create_all(created)
+    assert _schema(migrated) == _schema(created)
+
+
+def test_order_totals_filled_after_the_migration():
+    """
+    The stored totals of existing orders are filled by the deferred step of their migration, once it is committed.
+
+    Uses its own in-memory SQLite database.
+    """
+    engine = create_engine("sqlite://")
+    migrate(engine)
+    with engine.begin() as conn:
+        order_id = conn.execute(
+            insert(Order).values(customer_name="Test", status="pending").returning(Order.id)
+        ).scalar()
+        conn.execute(insert(OrderItem), [
+            {"order_id": order_id, "product_id": 1, "quantity": 2, "price": 5.0},
+            {"order_id": order_id, "product_id": 2, "quantity": 1, "price": 3.0},
+        ])
+        conn.execute(delete(schema_migrations).where(schema_migrations.c.version == 7))
+
+    assert migrate(engine) == [7]
+    with engine.connect() as conn:
+        assert conn.execute(select(Order.total, Order.item_count)).one() == (13.0, 2)
+
+
+def test_existing_orders_hold_no_stock():
+    """
+    Orders created before stock reservations existed are migrated as not holding any stock.
+
+    Uses its own in-memory SQLite database.
+    """
+    engine = create_engine("sqlite://")
+    migrate(engine)
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE orders DROP COLUMN stock_reserved"))
+        conn.execute(text("INSERT INTO orders (customer_name, status) VALUES ('Legacy', 'pending')"))
+        conn.execute(delete(schema_migrations).where(schema_migrations.c.version == 8))
+
+    assert migrate(engine) == [8]
+    with engine.connect() as conn:
+        assert conn.scalar(select(Order.stock_reserved)) is False
@@ -1,7 +1,16 @@
+from fastapi import HTTPException
 from fastapi.testclient import TestClient
+from datetime import datetime
 from typing import Any
+import json
 import pytest
 from Order.apis import order_app
+from Order.filters import ORDER_INDEXES, ORDER_SORTS, filter_orders
+from Order.models import Order, OrderItem
+from Product.models import Product
+from Order import totals
+from custom_function import engine, keyset
+from sqlalchemy import insert, select, update
 from sqlalchemy.orm import Session
 
 @pytest.fixture
@@ -9,6 +18,29 @@ def test_client() -> TestClient:
     with TestClient(order_app) as client:
         yield client
 
+
+def _create_product(stock, price=1.0):
+    with engine.begin() as conn:
+        return conn.scalar(
+            insert(Product).values(name="Order Test Product", price=price, stock=stock).returning(Product.id)
+        )
+
+
+def _create_order(test_client, product_id, quantity=1, order_status="pending"):
+    order_data = {
+        "customer_name": "Test Customer",
+        "customer_address": "Test Address",
+        "order_date": "2024-01-01T00:00:00",
+        "status": order_status,
+        "items": [{"product_id": product_id, "quantity": quantity}],
+    }
+    return test_client.post("/", json=order_data).json()["id"]
+
+
+def _stock(product_id):
+    with engine.connect() as conn:
+        return conn.scalar(select(Product.stock).where(Product.id == product_id))
+
 async def test_get_all_orders(test_client: TestClient):
     """
     Retrieving all orders.
@@ -230,3 +262,384 @@ async def test_get_order_items_nonexistent_order(test_client: TestClient, db: Se
     """
     response = await test_client.get("/orders/12/items")
     assert response.status_code == 404
+
+
+def test_get_all_orders_paginated(test_client: TestClient):
+    """
+    Retrieving orders page by page using the keyset cursor.
+
+    Args:
+        test_client: A TestClient instance for making API requests.
+
+    Returns:
+        A JSON object with the page `items` and the `next_cursor` to fetch the next page.
+    """
+    response = test_client.get("/", params={"limit": 1})
+    assert response.status_code == 200
+    page = response.json()
+    assert len(page["items"]) <= 1
+    if page["next_cursor"] is not None:
+        response = test_client.get("/", params={"after": page["next_cursor"], "limit": 1})
+        assert response.status_code == 200
+        assert all(item["id"] > page["next_cursor"] for item in response.json()["items"])
+
+
+def test_create_order_insufficient_stock(test_client: TestClient):
+    """
+    Creating an order asking for more stock than any product holds.
+
+    The reservation must fail and the whole order must be rolled back.
+
+    Args:
+        test_client: A TestClient instance for making API requests.
+
+    Returns:
+            A JSON error with status code 409 (Conflict).
+    """
+    product_id = _create_product(stock=5)
+    with pytest.raises(HTTPException) as exc_info:
+        _create_order(test_client, product_id, quantity=6)
+    assert exc_info.value.status_code == 409
+    assert _stock(product_id) == 5
+
+
+def test_get_order_items_query_budget(test_client: TestClient, assert_max_queries):
+    """
+    Retrieving the items of an order must not run one query per item.
+
+    Args:
+        test_client: A TestClient instance for making API requests.
+        assert_max_queries: Fixture asserting the number of statements run.
+    """
+    order_id = _create_order(test_client, _create_product(stock=5))
+    test_client.post(f"/{order_id}/items", json=[{"product_id": _create_product(stock=5), "quantity": 1}])
+    with assert_max_queries(2):
+        response = test_client.get(f"/{order_id}/items")
+    assert response.status_code == 200 and len(response.json()) == 2
+
+
+def test_order_stats_follow_status_change(test_client: TestClient):
+    """
+    Changing an order status moves it between the status counts of the stats rollup.
+
+    Args:
+        test_client: A TestClient instance for making API requests.
+
+    Returns:
+        JSON lists of order counts per status, before and after the change.
+    """
+    order_data = {
+        "customer_name": "Test Customer",
+        "customer_address": "Test Address",
+        "order_date": "2024-01-01T00:00:00",
+        "status": "pending",
+    }
+    order_id = test_client.post("/bulk", json=[order_data]).json()["created"][0]["id"]
+
+    def counts():
+        response = test_client.get("/stats/status", params={"date_from": "2024-01-01", "date_to": "2024-01-01"})
+        assert response.status_code == 200
+        return {row["status"]: row["order_count"] for row in response.json()}
+
+    before = counts()
+    assert test_client.patch(f"/{order_id}/status", json={"status": "cancelled"}).status_code == 200
+    after = counts()
+    assert after.get("pending", 0) == before["pending"] - 1
+    assert after["cancelled"] == before.get("cancelled", 0) + 1
+
+
+def test_get_all_orders_filtered_by_date(test_client: TestClient):
+    """
+    Retrieving the pending orders, newest first, page by page.
+
+    Args:
+        test_client: A TestClient instance for making API requests.
+
+    Returns:
+        JSON pages holding only matching orders, in descending date order.
+    """
+    params = {"status": "pending", "sort": "-order_date", "limit": 1}
+    orders = []
+    after = None
+    while True:
+        response = test_client.get("/", params={**params, **({"after": after} if after else {})})
+        assert response.status_code == 200
+        page = response.json()
+        orders += page["items"]
+        after = page["next_cursor"]
+        if after is None:
+            break
+    assert all(order["status"] == "pending" for order in orders)
+    keys = [(order["order_date"], order["id"]) for order in orders]
+    assert keys == sorted(keys, reverse=True)
+
+
+def test_get_all_orders_of_a_day(test_client: TestClient):
+    """
+    Retrieving a day's pending orders without choosing a sort, the date range sorts them by date.
+
+    Args:
+        test_client: A TestClient instance for making API requests.
+
+    Returns:
+        A JSON page with the day's pending orders, oldest first.
+    """
+    rows = [
+        {"customer_name": "Day", "customer_address": "x", "order_date": f"2031-05-0{day}T{hour:02}:00:00",
+         "status": order_status}
+        for day, hour, order_status in ((1, 11, "pending"), (1, 9, "pending"), (1, 10, "fulfilled"), (2, 9, "pending"))
+    ]
+    ids = [row["id"] for row in test_client.post("/bulk", json=rows).json()["created"]]
+    day = {"order_date_from": "2031-05-01T00:00:00", "order_date_to": "2031-05-02T00:00:00"}
+
+    response = test_client.get("/", params={**day, "status": "pending"})
+    assert response.status_code == 200
+    assert [order["id"] for order in response.json()["items"]] == [ids[1], ids[0]]
+    response = test_client.get("/", params=day)
+    assert response.status_code == 200
+    assert [order["id"] for order in response.json()["items"]] == [ids[1], ids[2], ids[0]]
+
+
+FILTER_VALUES = {
+    "status": {"order_status": "pending"},
+    "order_date": {"order_date_from": datetime(2024, 1, 1), "order_date_to": datetime(2024, 1, 2)},
+    "customer_name": {"customer_name": "Test"},
+}
+
+
+def _plan_indexes(plan):
+    if isinstance(plan, list):
+        return [name for node in plan for name in _plan_indexes(node)]
+    if not isinstance(plan, dict):
+        return []
+    names = [plan["Index Name"]] if "Index Name" in plan else []
+    return names + [name for value in plan.values() for name in _plan_indexes(value)]
+
+
+@pytest.mark.skipif(engine.dialect.name != "postgresql", reason="query plans are checked on PostgreSQL")
+@pytest.mark.parametrize("descending", [False, True])
+@pytest.mark.parametrize("combination", list(ORDER_INDEXES))
+def test_order_filters_use_indexes(combination, descending):
+    """
+    Every filter and sort combination of the order list runs on the index meant for it.
+
+    Sequential scans are disabled so the plan does not depend on the size of
+    the test tables, the index named in `ORDER_INDEXES` must then show up in it.
+    """
+    names, sort = combination
+    filters = {key: value for name in names for key, value in FILTER_VALUES[name].items()}
+    sort_column, _ = ORDER_SORTS[sort]
+    query = keyset(filter_orders(select(Order.id), **filters), Order.id, None, 50, sort_column, descending)
+    compiled = query.compile(engine)
+    with engine.begin() as conn:
+        conn.exec_driver_sql("SET LOCAL enable_seqscan = off")
+        plan = conn.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {compiled}", compiled.params).scalar()
+    assert "Seq Scan" not in json.dumps(plan)
+    assert ORDER_INDEXES[combination] in _plan_indexes(plan)
+
+
+def test_get_all_orders_unsupported_filters(test_client: TestClient):
+    """
+    Combining filters and sort in a way no index serves is refused.
+
+    Args:
+        test_client: A TestClient instance for making API requests.
+
+    Returns:
+        A JSON error with status code 422 (Unprocessable Entity).
+    """
+    with pytest.raises(HTTPException) as exc_info:
+        test_client.get("/", params={"customer_name": "Test", "sort": "-order_date"})
+    assert exc_info.value.status_code == 422
+
+
+def test_order_totals_stored(test_client: TestClient):
+    """
+    Creating an order stores its total and item count, which the repair job then finds correct.
+
+    Args:
+        test_client: A TestClient instance for making API requests.
+
+    Returns:
+        A JSON object of the order with its `total` and `item_count`.
+    """
+    product_id = _create_product(stock=5, price=2.5)
+    order_data = {
+        "customer_name": "Test Customer",
+        "customer_address": "Test Address",
+        "order_date": "2024-01-01T00:00:00",
+        "status": "pending",
+        "items": [{"product_id": product_id, "quantity": 2}, {"product_id": product_id, "quantity": 1}],
+    }
+    order_id = test_client.post("/", json=order_data).json()["id"]
+    order = test_client.get(f"/{order_id}").json()
+    items = test_client.get(f"/{order_id}/items").json()
+    assert order["item_count"] == len(items) == 2
+    assert order["total"] == pytest.approx(sum(item["quantity"] * item["price"] for item in items))
+
+    with engine.begin() as conn:
+        conn.execute(update(Order).where(Order.id == order_id).values(total=0, item_count=0))
+    assert totals.repair(engine, fix=False) >= 1
+    totals.repair(engine)
+    assert totals.repair(engine, fix=False) == 0
+    assert test_client.get(f"/{order_id}").json()["total"] == order["total"]
+
+
+def test_add_order_items(test_client: TestClient, assert_max_queries):
+    """
+    Adding many lines to an order in one request, priced from the products.
+
+    Args:
+        test_client: A TestClient instance for making API requests.
+        assert_max_queries: Fixture asserting the number of statements run.
+
+    Returns:
+        A JSON list of the inserted items, and the order with its totals updated.
+    """
+    order_data = {
+        "customer_name": "Test Customer",
+        "customer_address": "Test Address",
+        "order_date": "2024-01-01T00:00:00",
+        "status": "cancelled",
+    }
+    order_id = test_client.post("/bulk", json=[order_data]).json()["created"][0]["id"]
+    lines = [{"product_id": _create_product(stock=5, price=2.0), "quantity": 1}] * 50
+    # Cancelled, so no stock is reserved: the lock, the insert, the totals and the rollup.
+    with assert_max_queries(4):
+        response = test_client.post(f"/{order_id}/items", json=lines)
+    assert response.status_code == 200
+    items = response.json()
+    assert len(items) == 50 and all(item["price"] is not None for item in items)
+    order = test_client.get(f"/{order_id}").json()
+    assert order["item_count"] == 50
+    assert order["total"] == pytest.approx(sum(item["quantity"] * item["price"] for item in items))
+
+
+def test_add_order_items_reserves_stock(test_client: TestClient, assert_max_queries):
+    """
+    Adding many lines to a pending order reserves their stock with a fixed number of statements.
+
+    A second request asking for more than is left is refused and reserves nothing.
+
+    Args:
+        test_client: A TestClient instance for making API requests.
+        assert_max_queries: Fixture asserting the number of statements run.
+
+    Returns:
+        A JSON list of the inserted items, then a JSON error with status code 409 (Conflict).
+    """
+    first, second = _create_product(stock=600, price=2.0), _create_product(stock=500, price=3.0)
+    order_data = {
+        "customer_name": "Test Customer",
+        "customer_address": "Test Address",
+        "order_date": "2024-01-01T00:00:00",
+        "status": "pending",
+    }
+    order_id = test_client.post("/bulk", json=[order_data]).json()["created"][0]["id"]
+    lines = [{"product_id": first, "quantity": 1}, {"product_id": second, "quantity": 1}] * 500
+    # The lock, the insert, the product locks (PostgreSQL), the reservation, the totals and the rollup.
+    with assert_max_queries(6):
+        response = test_client.post(f"/{order_id}/items", json=lines)
+    assert response.status_code == 200 and len(response.json()) == 1000
+
+    with pytest.raises(HTTPException) as exc_info:
+        test_client.post(f"/{order_id}/items", json=lines[:2])
+    assert exc_info.value.status_code == 409 and str(second) in exc_info.value.detail
+    assert (_stock(first), _stock(second)) == (100, 0)
+    assert test_client.get(f"/{order_id}").json()["item_count"] == 1000
+
+
+def test_add_order_items_unknown_product(test_client: TestClient):
+    """
+    Adding lines for a product that does not exist inserts none of them.
+
+    Args:
+        test_client: A TestClient instance for making API requests.
+
+    Returns:
+        A JSON error with status code 404 (Not Found).
+    """
+    product_id = _create_product(stock=5)
+    order_id = _create_order(test_client, product_id)
+    with pytest.raises(HTTPException) as exc_info:
+        lines = [{"product_id": product_id, "quantity": 1}, {"product_id": 10**9, "quantity": 1}]
+        test_client.post(f"/{order_id}/items", json=lines)
+    assert exc_info.value.status_code == 404
+    assert test_client.get(f"/{order_id}").json()["item_count"] == 1 and _stock(product_id) == 4
+
+
+def test_cancel_order_without_reservation_keeps_stock(test_client: TestClient):
+    """
+    Cancelling or deleting an order that never reserved stock, as orders created before reservations, gives none back.
+
+    Args:
+        test_client: A TestClient instance for making API requests.
+    """
+    product_id = _create_product(stock=10)
+    with engine.begin() as conn:
+        order_ids = [
+            conn.scalar(insert(Order).values(
+                customer_name="Legacy", status="pending", order_date=datetime(2024, 1, 1), stock_reserved=False,
+            ).returning(Order.id))
+            for _ in range(2)
+        ]
+        conn.execute(insert(OrderItem), [
+            {"order_id": order_id, "product_id": product_id, "quantity": 3, "price": 1.0} for order_id in order_ids
+        ])
+    test_client.patch(f"/{order_ids[0]}/status", json={"status": "cancelled"})
+    test_client.delete(f"/{order_ids[1]}")
+    assert _stock(product_id) == 10
+
+    # Reopening takes the stock, cancelling again gives it back.
+    test_client.patch(f"/{order_ids[0]}/status", json={"status": "pending"})
+    assert _stock(product_id) == 7
+    test_client.patch(f"/{order_ids[0]}/status", json={"status": "cancelled"})
+    assert _stock(product_id) == 10
+
+
+def test_delete_fulfilled_order_keeps_stock(test_client: TestClient):
+    """
+    Deleting a fulfilled order does not restock its shipped items, deleting a pending one does.
+
+    Args:
+        test_client: A TestClient instance for making API requests.
+    """
+    product_id = _create_product(stock=10)
+    order_data = {
+        "customer_name": "Test Customer",
+        "customer_address": "Test Address",
+        "order_date": "2024-01-01T00:00:00",
+        "items": [{"product_id": product_id, "quantity": 3}],
+    }
+    fulfilled = test_client.post("/", json={**order_data, "status": "fulfilled"}).json()["id"]
+    pending = test_client.post("/", json={**order_data, "status": "pending"}).json()["id"]
+    assert _stock(product_id) == 4
+    test_client.delete(f"/{fulfilled}")
+    assert _stock(product_id) == 4
+    test_client.delete(f"/{pending}")
+    assert _stock(product_id) == 7
+
+
+def test_create_orders_bulk_rejects_items(test_client: TestClient):
+    """
+    A bulk order row sending items is reported in the errors instead of being created without them.
+
+    Args:
+        test_client: A TestClient instance for making API requests.
+
+    Returns:
+        A JSON object with the valid row in `created` and the one with items in `errors`.
+    """
+    product_id = _create_product(stock=10)
+    order_data = {
+        "customer_name": "Test Customer",
+        "customer_address": "Test Address",
+        "order_date": "2024-01-01T00:00:00",
+        "status": "pending",
+    }
+    rows = [order_data, {**order_data, "items": [{"product_id": product_id, "quantity": 1}]}]
+    response = test_client.post("/bulk", json=rows)
+    result = response.json()
+    assert [row["index"] for row in result["created"]] == [0]
+    assert [row["index"] for row in result["errors"]] == [1]
+    assert _stock(product_id) == 10
@@ -1,8 +1,13 @@
 from fastapi.testclient import TestClient
-from fastapi import Depends
-from custom_function import get_db
+from fastapi import Depends, HTTPException
+from custom_function import async_engine, engine, get_db
+import asyncio
 import pytest
+from cache import LRUCache
 from Product.apis import product_app
+from Supplier.models import Supplier
+from Warehouse.models import Warehouse
+from sqlalchemy import event, insert
 from sqlalchemy.orm import Session
 
 @pytest.fixture
@@ -10,6 +15,19 @@ def test_client() -> TestClient:
   with TestClient(product_app) as client:
     yield client
 
+
+def _product_data(capacity=None, **values):
+    """
+    A product body for a supplier and a warehouse (of `capacity`) created for the test.
+    """
+    with engine.begin() as conn:
+        supplier_id = conn.scalar(insert(Supplier).values(name="Test Supplier").returning(Supplier.id))
+        warehouse_id = conn.scalar(
+            insert(Warehouse).values(location="Test Warehouse", capacity=capacity).returning(Warehouse.id)
+        )
+    product = {"name": "Test Product", "price": 1, "supplier_id": supplier_id, "stock": 1, "warehouse_id": warehouse_id}
+    return {**product, **values}
+
 async def test_get_all_products(test_client: TestClient, db: Session= Depends(get_db)):
     """
     Retrieves all products from the database.
@@ -202,3 +220,260 @@ async def test_delete_product_nonexistent(test_client: TestClient):
     """
     response = await test_client.delete("/2")
     assert response.status_code == 404
+
+
+def test_get_all_products_paginated(test_client: TestClient):
+    """
+    Retrieves products page by page using the keyset cursor.
+
+    Args:
+        test_client: A TestClient instance for making API requests.
+
+    Returns:
+        A JSON object with the page `items` and the `next_cursor` to fetch the next page.
+    """
+    response = test_client.get("/", params={"limit": 1})
+    assert response.status_code == 200
+    page = response.json()
+    assert len(page["items"]) <= 1
+    if page["next_cursor"] is not None:
+        response = test_client.get("/", params={"after": page["next_cursor"], "limit": 1})
+        assert response.status_code == 200
+        assert all(item["id"] > page["next_cursor"] for item in response.json()["items"])
+
+
+
+def test_create_products_bulk(test_client: TestClient):
+    """
+    Creates several products in one request, one of them invalid.
+
+    Args:
+        test_client: A TestClient instance for making API requests.
+
+    Returns:
+        A JSON object listing the created products and the rejected row with its errors.
+    """
+    products = [
+        _product_data(name="Bulk Product", price=1.5, stock=3),
+        {"description": "Missing the required fields"},
+    ]
+    response = test_client.post("/bulk", json=products)
+    assert response.status_code == 200
+    assert [error["index"] for error in response.json()["errors"]] == [1]
+
+
+def test_search_products_ranked(test_client: TestClient):
+    """
+    Searches products by name, exact name matches must come first.
+
+    Args:
+        test_client: A TestClient instance for making API requests.
+
+    Returns:
+        A JSON list of matching products ordered by relevance.
+    """
+    response = test_client.get("/search/", params={"name": "Test Product", "limit": 5})
+    assert response.status_code == 200
+    products = response.json()
+    assert len(products) <= 5
+    if products:
+        assert "test product" in products[0]["name"].lower()
+
+
+def test_export_products_csv(test_client: TestClient):
+    """
+    Exports the products as a streamed CSV file.
+
+    Args:
+        test_client: A TestClient instance for making API requests.
+
+    Returns:
+        A CSV file starting with the header row of the product columns.
+    """
+    response = test_client.get("/export", params={"format": "csv"})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/csv")
+    assert response.text.splitlines()[0] == "id,name,description,price,supplier_id,stock,warehouse_id"
+
+
+def test_get_all_products_query_budget(test_client: TestClient, assert_max_queries):
+    """
+    Retrieves a page of products with a single query.
+
+    Args:
+        test_client: A TestClient instance for making API requests.
+        assert_max_queries: Fixture asserting the number of statements run.
+    """
+    with assert_max_queries(1):
+        test_client.get("/", params={"limit": 10})
+
+
+def test_update_products_stock_bulk(test_client: TestClient):
+    """
+    Updates the stock of several products at once, one of them missing.
+
+    Args:
+        test_client: A TestClient instance for making API requests.
+
+    Returns:
+        A JSON object with the number of updated products and the missing ids.
+    """
+    product_id = test_client.post("/", json=_product_data(stock=3)).json()["id"]
+    adjustments = [
+        {"product_id": product_id, "delta": 2},
+        {"product_id": 10**9, "stock": 5},
+    ]
+    response = test_client.patch("/stock", json=adjustments)
+    assert response.status_code == 200
+    assert response.json() == {"updated": 1, "missing": [10**9], "rejected": []}
+    assert test_client.get(f"/{product_id}").json()["stock"] == 5
+
+
+def test_update_products_stock_bulk_negative(test_client: TestClient):
+    """
+    A stock change that would leave a product below zero is rejected, the others are applied.
+
+    Args:
+        test_client: A TestClient instance for making API requests.
+
+    Returns:
+        A JSON object listing the rejected product.
+    """
+    product_data = _product_data(name="Feed Product", stock=5)
+    product_id = test_client.post("/", json=product_data).json()["id"]
+    response = test_client.patch("/stock", json=[{"product_id": product_id, "delta": -6}])
+    assert response.status_code == 200
+    assert response.json() == {"updated": 0, "missing": [], "rejected": [product_id]}
+    assert test_client.get(f"/{product_id}").json()["stock"] == 5
+    response = test_client.patch("/stock", json=[{"product_id": product_id, "delta": -5}])
+    assert response.json()["updated"] == 1
+
+
+def test_create_product_over_warehouse_capacity(test_client: TestClient):
+    """
+    Creating a product whose stock does not fit in its warehouse.
+
+    Args:
+        test_client: A TestClient instance for making API requests.
+
+    Returns:
+        A JSON error with status code 409 (Conflict).
+    """
+    product_data = _product_data(capacity=100, name="Bulky", stock=101)
+    with pytest.raises(HTTPException) as exc_info:
+        test_client.post("/", json=product_data)
+    assert exc_info.value.status_code == 409
+
+
+def test_bulk_writes_over_warehouse_capacity(test_client: TestClient):
+    """
+    Bulk creates and stock feeds cannot fill a warehouse past its capacity either.
+
+    Args:
+        test_client: A TestClient instance for making API requests.
+
+    Returns:
+        The oversize product reported as a row error, and a 409 for the oversize feed.
+    """
+    fits = _product_data(capacity=100, name="Fits", stock=1)
+    products = [fits, {**fits, "name": "Too big", "stock": 100}]
+    result = test_client.post("/bulk", json=products).json()
+    assert [error["index"] for error in result["errors"]] == [1]
+    product_id = result["created"][0]["id"]
+
+    with pytest.raises(HTTPException) as exc_info:
+        test_client.patch("/stock", json=[{"product_id": product_id, "delta": 100}])
+    assert exc_info.value.status_code == 409
+    assert test_client.get(f"/{product_id}").json()["stock"] == 1
+
+
+def test_update_product_partial(test_client: TestClient):
+    """
+    Updating a product with only some fields leaves the others untouched.
+
+    Args:
+        test_client: A TestClient instance for making API requests.
+
+    Returns:
+        A JSON message indicating successful update.
+    """
+    product_id = test_client.post("/", json=_product_data(description="Before")).json()["id"]
+    before = test_client.get(f"/{product_id}").json()
+    response = test_client.put(f"/{product_id}", json={"description": "Only the description changes"})
+    assert response.status_code == 200
+    after = test_client.get(f"/{product_id}").json()
+    assert after["description"] == "Only the description changes"
+    assert {**after, "description": before["description"]} == before
+
+
+def test_get_all_products_fields(test_client: TestClient):
+    """
+    Retrieving only some fields of the products.
+
+    Args:
+        test_client: A TestClient instance for making API requests.
+
+    Returns:
+        A JSON page whose items only hold the id and the requested fields.
+    """
+    response = test_client.get("/", params={"fields": "name,price", "limit": 5})
+    assert response.status_code == 200
+    for item in response.json()["items"]:
+        assert set(item) == {"id", "name", "price"}
+
+
+def test_get_all_products_unknown_field(test_client: TestClient):
+    """
+    Asking for a field products do not have is rejected.
+
+    Args:
+        test_client: A TestClient instance for making API requests.
+
+    Returns:
+        A JSON error with status code 422 (Unprocessable Entity).
+    """
+    with pytest.raises(HTTPException) as exc_info:
+        test_client.get("/", params={"fields": "name,colour"})
+    assert exc_info.value.status_code == 422
+
+
+def test_get_product_cache_hit_without_connection(test_client: TestClient):
+    """
+    A product served from the cache does not check out a database connection.
+
+    Args:
+        test_client: A TestClient instance for making API requests.
+    """
+    product_data = _product_data(name="Cached")
+    product_id = test_client.post("/", json=product_data).json()["id"]
+    test_client.get(f"/{product_id}")
+    checkouts = []
+    listener = lambda *args: checkouts.append(args)
+    event.listen(async_engine.sync_engine.pool, "checkout", listener)
+    try:
+        for _ in range(5):
+            assert test_client.get(f"/{product_id}").status_code == 200
+    finally:
+        event.remove(async_engine.sync_engine.pool, "checkout", listener)
+    assert checkouts == []
+
+
+def test_cache_skips_fill_evicted_while_loading():
+    """
+    A row read before a write evicted the key is not cached, a later load is.
+    """
+
+    async def scenario():
+        cache = LRUCache(maxsize=1)
+        generation = await cache.generation(1)
+        await cache.delete(1)
+        await cache.set(1, "stale", generation)
+        stale = await cache.get(1)
+        # Dropping the tombstone of key 1 must not bring its old generation back.
+        await cache.delete(2)
+        await cache.set(1, "stale", generation)
+        still_stale = await cache.get(1)
+        await cache.set(1, "fresh", await cache.generation(1))
+        return stale, still_stale, await cache.get(1)
+
+    assert asyncio.run(scenario()) == (None, None, "fresh")
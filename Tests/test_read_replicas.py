@@ -0,0 +1,76 @@
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, insert
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import NullPool
+
+import custom_function
+from custom_function import READ_PRIMARY_COOKIE, read_sessionmaker
+from main import app
+from migrations import migrate
+from Warehouse.models import Warehouse
+
+# A warehouse only the replicas hold, its capacity tells which replica served the read.
+REPLICA_WAREHOUSE = 10**6
+
+
+@pytest.fixture
+def replicas(tmp_path, monkeypatch):
+    """
+    Two SQLite files standing in for the read replicas, each holding `REPLICA_WAREHOUSE` with its own capacity.
+    """
+    sessions = []
+    for capacity in (1, 2):
+        path = tmp_path / f"replica{capacity}.db"
+        replica = create_engine(f"sqlite:///{path}")
+        migrate(replica)
+        with replica.begin() as conn:
+            conn.execute(insert(Warehouse).values(id=REPLICA_WAREHOUSE, location="Replica", capacity=capacity))
+        replica.dispose()
+        replica_engine = create_async_engine(f"sqlite+aiosqlite:///{path}", poolclass=NullPool)
+        sessions.append(async_sessionmaker(replica_engine, autoflush=False, expire_on_commit=False))
+    monkeypatch.setattr(custom_function, "ReplicaSessions", sessions)
+    return sessions
+
+
+@pytest.fixture
+def test_client() -> TestClient:
+    with TestClient(app) as client:
+        yield client
+
+
+def _replica_capacity(test_client):
+    return test_client.get(f"/warehouse/{REPLICA_WAREHOUSE}/utilisation").json()["capacity"]
+
+
+def test_reads_balanced_over_replicas(replicas, test_client: TestClient):
+    """
+    Consecutive reads go to different replicas.
+
+    Args:
+        replicas: The two replica session factories.
+        test_client: A TestClient instance for making API requests.
+    """
+    assert read_sessionmaker() is not read_sessionmaker()
+    assert {_replica_capacity(test_client) for _ in range(2)} == {1, 2}
+
+
+def test_write_pins_reads_to_primary(replicas, test_client: TestClient):
+    """
+    A write sets the cookie keeping the client's reads on the primary, which sees the write.
+
+    Args:
+        replicas: The two replica session factories.
+        test_client: A TestClient instance for making API requests.
+    """
+    response = test_client.post("/warehouse/warehouse", json={"location": "Pinned Warehouse", "capacity": 7})
+    assert response.status_code == 200
+    assert READ_PRIMARY_COOKIE in response.cookies
+    warehouse_id = response.json()["id"]
+
+    response = test_client.get(f"/warehouse/{warehouse_id}/utilisation")
+    assert response.status_code == 200 and response.json()["capacity"] == 7
+
+    test_client.cookies.clear()
+    assert test_client.get(f"/warehouse/{warehouse_id}/utilisation").status_code == 404
+    assert _replica_capacity(test_client) in (1, 2)
@@ -1,17 +1,67 @@
-from fastapi import Depends, APIRouter
-from sqlalchemy.orm import Session
+from typing import Any, Dict, List
 
-from custom_function import get_db
+from fastapi import Depends, APIRouter, HTTPException, status
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from .schema import WareHouseCreate
+from custom_function import BulkResult, bulk_insert, get_async_db, get_read_db
+from metrics import query_budget
+
+from .capacity import utilisation_query
+from .schema import WareHouseCreate, WareHouseRead, WarehouseUtilisation
 from .models import Warehouse 
 
 warehouse_app = APIRouter()
 
-@warehouse_app.post("/warehouse")
-async def create_warehouse(warehouse: WareHouseCreate, db: Session = Depends(get_db)):
-    new_warehouse = Warehouse(**warehouse.dict())
-    db.add(new_warehouse)
-    db.commit()
-    db.refresh(new_warehouse)
+@warehouse_app.post("/warehouse", response_model=WareHouseRead, dependencies=[Depends(query_budget(1))])
+async def create_warehouse(warehouse: WareHouseCreate, db: AsyncSession = Depends(get_async_db)):
+    new_warehouse = await db.scalar(insert(Warehouse).values(**warehouse.model_dump()).returning(Warehouse))
+    await db.commit()
     return new_warehouse
+
+
+@warehouse_app.post("/bulk", response_model=BulkResult, dependencies=[Depends(query_budget(allow_repeats=True))])
+async def create_warehouses_bulk(warehouses: List[Dict[str, Any]], db: AsyncSession = Depends(get_async_db)):
+    return await bulk_insert(db, Warehouse, WareHouseCreate, warehouses)
+
+
+def _utilisation(row):
+    utilisation = row.used / row.capacity if row.capacity else None
+    return {"warehouse_id": row.warehouse_id, "capacity": row.capacity, "used": row.used, "utilisation": utilisation}
+
+
+@warehouse_app.get("/utilisation", response_model=List[WarehouseUtilisation], dependencies=[Depends(query_budget(1))])
+async def get_warehouses_utilisation(db: AsyncSession = Depends(get_read_db)):
+    """
+    Retrieving the stock stored in every warehouse against its capacity.
+
+    Args:
+        db: A database session dependency (fixture) for database access.
+
+    Returns:
+        A JSON list with the `capacity`, `used` stock and `utilisation` ratio of each warehouse.
+    """
+    return [_utilisation(row) for row in await db.execute(utilisation_query())]
+
+
+@warehouse_app.get(
+    "/{warehouse_id}/utilisation", response_model=WarehouseUtilisation, dependencies=[Depends(query_budget(1))],
+)
+async def get_warehouse_utilisation(warehouse_id: int, db: AsyncSession = Depends(get_read_db)):
+    """
+    Retrieving the stock stored in a warehouse against its capacity.
+
+    Args:
+        warehouse_id: The ID of the warehouse.
+        db: A database session dependency (fixture) for database access.
+
+    Returns:
+        A JSON object with the `capacity`, `used` stock and `utilisation` ratio of the warehouse.
+
+    Raises:
+        HTTPException: If the warehouse with the provided ID is not found.
+    """
+    row = (await db.execute(utilisation_query().where(Warehouse.id == warehouse_id))).first()
+    if row is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Warehouse not found")
+    return _utilisation(row)
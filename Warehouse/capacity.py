@@ -0,0 +1,89 @@
+from sqlalchemy import func, select
+
+from Product.models import Product
+
+from .models import Warehouse
+
+
+def utilisation_query():
+    """
+    Stock stored in each warehouse against its capacity, summed from the
+    `(warehouse_id, stock)` index rather than the product rows.
+    """
+    used = func.coalesce(func.sum(Product.stock), 0).label("used")
+    return (
+        select(Warehouse.id.label("warehouse_id"), Warehouse.capacity, used)
+        .outerjoin(Product, Product.warehouse_id == Warehouse.id)
+        .group_by(Warehouse.id, Warehouse.capacity)
+        .order_by(Warehouse.id)
+    )
+
+
+async def has_room(db, warehouse_id, stock, product_id=None):
+    """
+    Checking that placing `stock` units in a warehouse keeps it within capacity.
+
+    The warehouse row is locked until the caller commits, so two placements
+    into the same warehouse cannot both pass the check. The stock is summed
+    in a second statement once the lock is held: under READ COMMITTED that
+    statement sees what the previous lock holder committed.
+
+    Order reservations only lower the stock and do not take this lock.
+    Releases (`Product.stock.release_stock`, when an order is cancelled or
+    deleted) do not either: they give back stock the warehouse held before,
+    but a placement made meanwhile may have used the room, so a release can
+    leave a warehouse over its capacity. The next placement into it is then
+    refused until stock leaves.
+
+    Args:
+        db: An async database session, the caller commits or rolls back.
+        warehouse_id: The warehouse receiving the stock, None always has room.
+        stock: The stock of the product being written.
+        product_id: The product being updated, its current stock is not counted.
+
+    Returns:
+        False if the warehouse would go over its capacity.
+    """
+    if warehouse_id is None or not stock:
+        return True
+    capacity = await db.scalar(select(Warehouse.capacity).where(Warehouse.id == warehouse_id).with_for_update())
+    if capacity is None:
+        return True
+    others = select(func.coalesce(func.sum(Product.stock), 0)).where(Product.warehouse_id == warehouse_id)
+    if product_id is not None:
+        others = others.where(Product.id != product_id)
+    return await db.scalar(others) + stock <= capacity
+
+
+async def room_left(db, warehouse_ids):
+    """
+    The capacity left in several warehouses, locking them like `has_room` does.
+
+    The warehouses are locked in id order, so batches touching the same
+    warehouses cannot deadlock, then their stock is summed in a second statement.
+
+    Args:
+        db: An async database session, the caller commits or rolls back.
+        warehouse_ids: The warehouses to check.
+
+    Returns:
+        A dict of warehouse id to capacity minus stored stock (negative when
+        over capacity), for the warehouses that exist and have a capacity.
+    """
+    ids = sorted(set(warehouse_ids) - {None})
+    if not ids:
+        return {}
+    capacities = dict((await db.execute(
+        select(Warehouse.id, Warehouse.capacity)
+        .where(Warehouse.id.in_(ids), Warehouse.capacity.is_not(None))
+        .order_by(Warehouse.id)
+        .with_for_update()
+    )).all())
+    if not capacities:
+        return {}
+    used = dict((await db.execute(
+        select(Product.warehouse_id, func.sum(Product.stock))
+        .where(Product.warehouse_id.in_(capacities))
+        .group_by(Product.warehouse_id)
+    )).all())
+    return {warehouse_id: capacity - (used.get(warehouse_id) or 0) for warehouse_id, capacity in capacities.items()}
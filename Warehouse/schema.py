@@ -1,5 +1,21 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
+from typing import Optional
 
 class WareHouseCreate(BaseModel):
     location: str
-    capacity: str
+    capacity: int
+
+
+class WareHouseRead(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    location: str
+    capacity: Optional[int] = None
+
+
+class WarehouseUtilisation(BaseModel):
+    warehouse_id: int
+    capacity: Optional[int] = None
+    used: int
+    utilisation: Optional[float] = None
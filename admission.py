@@ -0,0 +1,231 @@
+"""
+Admission control: a concurrency limit and a bounded wait queue per router and
+kind of request (reads are GET/HEAD, writes everything else).
+
+When the database slows down, requests wait here, a few at a time and for a
+bounded time, instead of piling up on the connection pool until everything
+times out together. Beyond the queue depth, or after `admission_queue_timeout`
+seconds in the queue, the request is shed with a 503 and a `Retry-After`
+header, so a slow `/orders` write path does not take `/product` reads down.
+
+Limits are configured with `admission_limits`, comma separated
+`router:kind=concurrency:queue_depth` entries:
+
+    admission_limits = /orders:write=4:16,/product:read=8:64
+
+Shedding is opt-in: unlisted routers and kinds are not limited, and with
+`admission_limits` empty (the default) nothing is shed. Size the concurrency
+of a kind from the pool serving it (the primary pool for writes, the replica
+pools or the primary for reads) and the queue depth from how many requests
+can be served within `admission_queue_timeout`.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+
+import orjson
+
+from custom_function import pool_options, replica_engines
+from metrics import LATENCY_BUCKETS, Histogram
+
+logger = logging.getLogger(__name__)
+
+ADMISSION_LIMITS = os.getenv("admission_limits", "")
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("admission_queue_timeout", 1))
+ADMISSION_RETRY_AFTER = int(os.getenv("admission_retry_after", 1))
+READ_METHODS = ("GET", "HEAD")
+
+
+class Limiter:
+    """
+    A semaphore with a bounded FIFO queue, counting shed requests and the time spent queued.
+
+    Only used from the event loop thread, so the counters need no locking.
+    """
+
+    def __init__(self, concurrency, queue_depth):
+        self.concurrency = concurrency
+        self.queue_depth = queue_depth
+        self.active = 0
+        self.waiters = deque()
+        self.shed = 0
+        self.wait = Histogram(LATENCY_BUCKETS)
+
+    async def acquire(self, timeout=ADMISSION_QUEUE_TIMEOUT):
+        """
+        Taking a slot, queueing for at most `timeout` seconds when all are taken.
+
+        Returns:
+            True when admitted (call `release` once done), False when shed.
+        """
+        if self.active < self.concurrency and not self.waiters:
+            self.active += 1
+            self.wait.observe(0)
+            return True
+        if len(self.waiters) >= self.queue_depth:
+            self.shed += 1
+            return False
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            # `release` handed us the slot in the same loop tick as the timeout (Python 3.12+): keep it,
+            # shedding here would leave it taken with nobody to release it.
+            if waiter.done() and not waiter.cancelled():
+                return True
+            self.shed += 1
+            return False
+        except BaseException:
+            # Cancelled after `release` handed us the slot: pass it on.
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            self.wait.observe(time.perf_counter() - start)
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+        return True
+
+    def release(self):
+        # The slot goes straight to the first waiter still waiting, `active` does not change.
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def stats(self):
+        return {
+            "concurrency": self.concurrency,
+            "queue_depth": self.queue_depth,
+            "active": self.active,
+            "queued": len(self.waiters),
+            "shed": self.shed,
+        }
+
+
+def pool_capacity():
+    """
+    The connections available to writes (the primary pool) and to reads (the replica pools, or the primary).
+    """
+    primary = pool_options["pool_size"] + pool_options["max_overflow"]
+    return {"write": primary, "read": primary * len(replica_engines) if replica_engines else primary}
+
+
+def parse_limits(text):
+    """
+    Parsing `admission_limits` into `{(router, kind): (concurrency, queue_depth)}`.
+
+    Raises:
+        ValueError: On a malformed entry.
+    """
+    limits = {}
+    for entry in filter(None, (entry.strip() for entry in text.split(","))):
+        try:
+            target, sizes = entry.split("=")
+            router, kind = target.strip().split(":")
+            concurrency, queue_depth = (int(size) for size in sizes.split(":"))
+        except ValueError:
+            raise ValueError(f"Invalid admission limit {entry!r}, expected router:kind=concurrency:queue_depth")
+        if kind not in ("read", "write") or concurrency < 1 or queue_depth < 0:
+            raise ValueError(f"Invalid admission limit {entry!r}, expected router:read|write=concurrency:queue_depth")
+        limits[(router, kind)] = (concurrency, queue_depth)
+    return limits
+
+
+def configure_limiters(routers, text=ADMISSION_LIMITS):
+    """
+    One `Limiter` per router and kind listed in `admission_limits`, the others are not limited.
+
+    Logs a warning when an entry names a router that is not served, and when
+    the configured limits let more requests of a kind run at once than its
+    pool has connections: the extra ones would wait on the pool (for up to
+    `pool_timeout`) instead of being shed.
+    """
+    capacity = pool_capacity()
+    limiters = {}
+    for (router, kind), (concurrency, queue_depth) in parse_limits(text).items():
+        if router not in routers:
+            logger.warning("Admission limit set for %s, which is not one of %s", router, ", ".join(routers))
+            continue
+        limiters[(router, kind)] = Limiter(concurrency, queue_depth)
+    for kind in ("read", "write"):
+        total = sum(limiter.concurrency for (_, limiter_kind), limiter in limiters.items() if limiter_kind == kind)
+        if total > capacity[kind]:
+            logger.warning(
+                "Admission limits let %d %ss run at once but their pools hold %d connections",
+                total, kind, capacity[kind],
+            )
+    return limiters
+
+
+# Filled by `AdmissionMiddleware`, read by the monitoring endpoints.
+limiters = {}
+
+
+def render_metrics():
+    lines = []
+    for name, kind, value in (
+        ("admission_active_requests", "gauge", "active"),
+        ("admission_queued_requests", "gauge", "queued"),
+        ("admission_concurrency_limit", "gauge", "concurrency"),
+        ("admission_shed_total", "counter", "shed"),
+    ):
+        lines.append(f"# TYPE {name} {kind}")
+        for (router, request_kind), limiter in sorted(limiters.items()):
+            lines.append(f'{name}{{router="{router}",kind="{request_kind}"}} {limiter.stats()[value]}')
+    lines += [
+        "# HELP admission_queue_wait_seconds Time spent waiting for an admission slot, by router and kind.",
+        "# TYPE admission_queue_wait_seconds histogram",
+    ]
+    for (router, request_kind), limiter in sorted(limiters.items()):
+        lines += limiter.wait.render("admission_queue_wait_seconds", f'router="{router}",kind="{request_kind}"')
+    return lines
+
+
+async def _shed(send, router, kind):
+    body = orjson.dumps({"detail": f"Too many {kind} requests on {router}, retry later"})
+    await send({
+        "type": "http.response.start",
+        "status": 503,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(ADMISSION_RETRY_AFTER).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+class AdmissionMiddleware:
+    """
+    ASGI middleware admitting requests through the limiter of their router and kind.
+
+    Requests on other routers (e.g. the monitoring endpoints) are not limited.
+    """
+
+    def __init__(self, app, routers=()):
+        self.app = app
+        limiters.update(configure_limiters(routers))
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        router = "/" + scope["path"].lstrip("/").split("/", 1)[0]
+        kind = "read" if scope["method"] in READ_METHODS else "write"
+        limiter = limiters.get((router, kind))
+        if limiter is None:
+            return await self.app(scope, receive, send)
+
+        if not await limiter.acquire():
+            return await _shed(send, router, kind)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limiter.release()
@@ -0,0 +1,102 @@
+import time
+from collections import OrderedDict
+
+
+class CacheBackend:
+    """
+    Interface of the read-through caches used by the routers.
+
+    Methods are async so a shared store (e.g. Redis) can be plugged in later
+    without touching the callers.
+    """
+
+    async def get(self, key):
+        raise NotImplementedError
+
+    async def generation(self, key):
+        """
+        A token to take before loading `key` from the database and pass to `set`.
+
+        A `delete` of the key in between changes it, so a load that read the
+        row before a write committed cannot cache the old row.
+        """
+        raise NotImplementedError
+
+    async def set(self, key, value, generation=None):
+        raise NotImplementedError
+
+    async def delete(self, key):
+        raise NotImplementedError
+
+    def stats(self):
+        raise NotImplementedError
+
+
+class LRUCache(CacheBackend):
+    """
+    In-process cache bounded to `maxsize` entries, each entry living at most `ttl` seconds.
+
+    The least recently used entry is evicted when the cache is full.
+
+    Deletes leave a tombstone numbered from a shared counter, the last
+    `maxsize` are kept. A key whose tombstone was dropped gets the number of
+    the latest dropped tombstone, so its generation never goes back.
+    """
+
+    def __init__(self, maxsize=10000, ttl=60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._tombstones = OrderedDict()
+        self._deletes = 0
+        self._dropped_tombstone = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    async def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    async def generation(self, key):
+        return self._tombstones.get(key, self._dropped_tombstone)
+
+    async def set(self, key, value, generation=None):
+        if generation is not None and generation != await self.generation(key):
+            return
+        self._entries[key] = (value, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def delete(self, key):
+        self._entries.pop(key, None)
+        self._deletes += 1
+        self._tombstones[key] = self._deletes
+        self._tombstones.move_to_end(key)
+        while len(self._tombstones) > self.maxsize:
+            _, self._dropped_tombstone = self._tombstones.popitem(last=False)
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
@@ -1,8 +1,27 @@
+import base64
+import binascii
+import csv
+import io
+import itertools
+import math
 import os
+import time
+from datetime import datetime
 
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
+import orjson
+from fastapi import HTTPException, Request, Response, status
+from fastapi.responses import StreamingResponse
+
+from typing import Any, Dict, List
+
+from pydantic import BaseModel, ValidationError
+from sqlalchemy import DateTime, create_engine, insert, make_url, select, tuple_, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import DBAPIError, TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -12,18 +31,446 @@ password = os.getenv("password")
 host = os.getenv("host", "")
 port = os.getenv("port", 5432)
 database_name = os.getenv("database_name")
+# A full SQLAlchemy URL (e.g. sqlite:///local.db) takes precedence over the credentials above.
+database_url = os.getenv("database_url") or f"postgresql://{username}:{password}@{host}:{port}/{database_name}"
+# Comma separated URLs of read replicas, the read-only endpoints are balanced over them.
+replica_urls = [url.strip() for url in os.getenv("replica_urls", "").split(",") if url.strip()]
+# After a write, reads of the same client stay on the primary for this many seconds (0 to disable).
+read_your_writes_seconds = float(os.getenv("read_your_writes_seconds", 5))
+READ_PRIMARY_COOKIE = "read_primary_until"
+
+pool_options = {
+    "pool_size": int(os.getenv("pool_size", 5)),
+    "max_overflow": int(os.getenv("max_overflow", 10)),
+    "pool_timeout": float(os.getenv("pool_timeout", 30)),
+    "pool_recycle": int(os.getenv("pool_recycle", 1800)),
+    "pool_pre_ping": os.getenv("pool_pre_ping", "true").lower() in ("1", "true", "yes"),
+}
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+BULK_CHUNK_SIZE = 1000
+EXPORT_BATCH_SIZE = 1000
+EXPORT_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+class Message(BaseModel):
+    message: str
+
+
+class BulkCreated(BaseModel):
+    index: int
+    id: int
+
+
+class BulkError(BaseModel):
+    index: int
+    errors: List[Dict[str, Any]]
+
+
+class BulkResult(BaseModel):
+    created: List[BulkCreated]
+    errors: List[BulkError]
+
+
+ASYNC_DRIVERS = {"postgresql": "postgresql+asyncpg", "sqlite": "sqlite+aiosqlite"}
+# INSERT constructs supporting ON CONFLICT, by dialect name.
+UPSERTS = {"postgresql": pg_insert, "sqlite": sqlite_insert}
+
+class PoolStats:
+    """
+    Connection wait times of the primary pool (see `TimedPool`), reported next
+    to the pool counters so workers can be sized against `max_connections`.
+    """
+
+    def __init__(self):
+        self.acquired = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def observe(self, seconds):
+        self.acquired += 1
+        self.wait_total += seconds
+        self.wait_max = max(self.wait_max, seconds)
+
+    def snapshot(self, pool):
+        stats = {}
+        if hasattr(pool, "checkedout"):
+            stats = {
+                "pool_size": pool.size(),
+                "checked_out": pool.checkedout(),
+                "idle": pool.checkedin(),
+                "overflow": max(pool.overflow(), 0),
+                "max_overflow": pool_options["max_overflow"],
+            }
+        return {
+            **stats,
+            "acquired": self.acquired,
+            "timeouts": self.timeouts,
+            "wait_avg_ms": self.wait_total / self.acquired * 1000 if self.acquired else 0.0,
+            "wait_max_ms": self.wait_max * 1000,
+        }
+
+
+pool_stats = PoolStats()
+
 
-engine = create_engine(f"postgresql://{username}:{password}@{host}:{port}/{database_name}")
+class TimedPool(AsyncAdaptedQueuePool):
+    """
+    The primary's pool, recording in `pool_stats` how long each checkout waited for a connection.
+
+    Sessions only check out a connection on their first statement, so
+    requests served without the database (e.g. cache hits) never wait here.
+    """
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            pool_stats.timeouts += 1
+            raise
+        pool_stats.observe(time.perf_counter() - start)
+        return connection
+
+
+def make_async_engine(url, poolclass=None):
+    url = make_url(url)
+    backend = url.get_backend_name()
+    url = url.set(drivername=ASYNC_DRIVERS.get(backend, url.drivername))
+    # SQLite is only used locally and keeps SQLAlchemy's default pool.
+    if backend == "sqlite":
+        return create_async_engine(url)
+    return create_async_engine(url, **pool_options, **({"poolclass": poolclass} if poolclass else {}))
+
+
+engine = create_engine(database_url)
+# Routers go through the async engine (asyncpg) so queries never block the event loop,
+# the sync engine above is kept for schema management and scripts.
+async_engine = make_async_engine(database_url, poolclass=TimedPool)
+replica_engines = [make_async_engine(url) for url in replica_urls]
 
 Base = declarative_base()
 
-Base.metadata.create_all(engine)
+# The schema is managed by `migrations`, applied at application startup.
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 def get_db():
-    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
     db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
+
+
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+ReplicaSessions = [
+    async_sessionmaker(replica_engine, autoflush=False, expire_on_commit=False) for replica_engine in replica_engines
+]
+_replica_turns = itertools.count()
+
+
+def read_sessionmaker():
+    """
+    The session factory of the next read replica, round robin, or of the primary when there are none.
+    """
+    return ReplicaSessions[next(_replica_turns) % len(ReplicaSessions)] if ReplicaSessions else AsyncSessionLocal
+
+
+def _reads_from_primary(request):
+    try:
+        return float(request.cookies.get(READ_PRIMARY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+async def get_async_db(request: Request, response: Response):
+    """
+    Session on the primary, for the write endpoints and reads that must be fresh.
+
+    When replicas are configured, a write also pins the client to the primary
+    for `read_your_writes_seconds` with a cookie honoured by `get_read_db`.
+    """
+    if ReplicaSessions and read_your_writes_seconds and request.method not in ("GET", "HEAD"):
+        response.set_cookie(
+            READ_PRIMARY_COOKIE, f"{time.time() + read_your_writes_seconds:.3f}",
+            max_age=math.ceil(read_your_writes_seconds), httponly=True,
+        )
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+async def get_read_db(request: Request):
+    """
+    Session for the read-only endpoints, balanced over the read replicas.
+
+    Uses the primary when no replicas are configured, and for clients that
+    wrote within the last `read_your_writes_seconds` so they see their writes.
+    """
+    if not ReplicaSessions or _reads_from_primary(request):
+        async with AsyncSessionLocal() as db:
+            yield db
+    else:
+        async with read_sessionmaker()() as db:
+            yield db
+
+
+def encode_cursor(*values):
+    """
+    An opaque, URL safe cursor holding the sort values of the last row of a page.
+    """
+    return base64.urlsafe_b64encode(orjson.dumps(values)).decode().rstrip("=")
+
+
+def decode_cursor(cursor, columns):
+    """
+    The values of an `encode_cursor` cursor, converted back to the types of `columns`.
+
+    Raises:
+        HTTPException: 422 if the cursor is not one we issued for these columns.
+    """
+    try:
+        values = orjson.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if not isinstance(values, list) or len(values) != len(columns):
+            raise ValueError(cursor)
+        return tuple(
+            datetime.fromisoformat(value) if isinstance(column.type, DateTime) else column.type.python_type(value)
+            for column, value in zip(columns, values)
+        )
+    except (ValueError, TypeError, binascii.Error, orjson.JSONDecodeError):
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Invalid cursor")
+
+
+def keyset(query, key, after=None, limit=DEFAULT_PAGE_SIZE, sort=None, descending=False):
+    """
+    The statement fetching one keyset page (plus one row, telling whether another page follows).
+
+    See `paginate` for the arguments.
+    """
+    if sort is None:
+        position, columns = key, (key,)
+    else:
+        position, columns = tuple_(sort, key), (sort, key)
+        # Rows without a sort value cannot be placed on the keyset.
+        query = query.where(sort.is_not(None))
+    if after is not None:
+        bound = after if sort is None else tuple_(*decode_cursor(after, columns))
+        query = query.where(position < bound if descending else position > bound)
+    return query.order_by(*(column.desc() if descending else column for column in columns)).limit(limit + 1)
+
+
+async def paginate(db, query, key, after=None, limit=DEFAULT_PAGE_SIZE, sort=None, descending=False):
+    """
+    Keyset (cursor) pagination over an ordered, unique column.
+
+    Instead of OFFSET the page starts right after the `after` cursor, so
+    the database seeks through the index and deep pages cost the same as
+    the first one.
+
+    Args:
+        db: An async database session.
+        query: A select of columns (see `select_fields`), including `key` and `sort`.
+        key: The unique, indexed column used as cursor (usually the id).
+        after: The cursor returned by the previous page, if any.
+        limit: Maximum number of rows in the page.
+        sort: A non unique column to order by before `key` (e.g. a date), rows
+            where it is NULL are left out. The cursor is then an opaque string
+            instead of a `key` value, the index should cover `(sort, key)`.
+        descending: Newest (largest) rows first.
+
+    Returns:
+        A dict with the page `items` and the `next_cursor` (None on the last page).
+    """
+    rows = (await db.execute(keyset(query, key, after, limit, sort, descending))).mappings().all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = last[key.key] if sort is None else encode_cursor(last[sort.key], last[key.key])
+    return {"items": rows, "next_cursor": next_cursor}
+
+
+def select_fields(model, fields=None):
+    """
+    The columns to select for a `?fields=id,name,price` projection, so only
+    those are read, sent over the wire and serialised.
+
+    The id is always included, it is the pagination cursor.
+
+    Args:
+        model: The mapped class.
+        fields: Comma separated column names, None or empty for all of them.
+
+    Returns:
+        A list of columns of the model's table, in table order.
+
+    Raises:
+        HTTPException: 422 listing the fields the model does not have.
+    """
+    columns = model.__table__.c
+    if not fields:
+        return list(columns)
+    names = {name.strip() for name in fields.split(",") if name.strip()}
+    unknown = sorted(names - set(columns.keys()))
+    if unknown:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Unknown fields {unknown}, choose from {list(columns.keys())}",
+        )
+    return [column for column in columns if column.key == "id" or column.key in names]
+
+
+async def update_returning_previous(db, model, key, values, previous):
+    """
+    Updating one row by id with a single UPDATE ... RETURNING, also returning
+    what some of its columns held before.
+
+    On PostgreSQL the previous values come from a `SELECT ... FOR UPDATE` of
+    the row joined into the UPDATE, so it stays one statement and they cannot
+    be stale. Other databases (SQLite for local testing) read them first and
+    update with a compare-and-set, retried if the row changed in between.
+
+    Args:
+        db: An async database session, the caller commits.
+        model: The mapped class, with an `id` primary key.
+        key: The id of the row.
+        values: The columns to set, not empty.
+        previous: The columns (e.g. `Order.status`) whose previous value is returned.
+
+    Returns:
+        The updated row as a mapping, plus a `previous_<column>` entry per
+        column of `previous`, or None when the row does not exist.
+    """
+    table = model.__table__
+    columns = [table.c[column.key] for column in previous]
+
+    if db.bind.dialect.name == "postgresql":
+        before = select(table.c.id, *columns).where(table.c.id == key).with_for_update().subquery("previous")
+        result = await db.execute(
+            update(table)
+            .where(table.c.id == before.c.id)
+            .values(**values)
+            .returning(*table.c, *(before.c[column.key].label(f"previous_{column.key}") for column in columns))
+        )
+        return result.mappings().first()
+
+    while True:
+        before = (await db.execute(select(*columns).where(table.c.id == key))).first()
+        if before is None:
+            return None
+        result = await db.execute(
+            update(table)
+            .where(table.c.id == key, *(column.is_not_distinct_from(value) for column, value in zip(columns, before)))
+            .values(**values)
+            .returning(*table.c)
+        )
+        row = result.mappings().first()
+        if row is not None:
+            return {**row, **{f"previous_{column.key}": value for column, value in zip(columns, before)}}
+
+
+async def bulk_insert(db, model, schema, rows, check=None, on_insert=None, chunk_size=BULK_CHUNK_SIZE):
+    """
+    Inserting many rows with multi-row INSERT ... RETURNING, one chunk at a time.
+
+    Every row is validated against `schema` (and `check`, if given) on its own
+    so a bad row is reported back instead of failing the whole batch. Each chunk
+    runs in a savepoint; when the database rejects a chunk (e.g. an unknown
+    foreign key or a value too long for its column) its rows are retried one
+    by one to single out the offenders.
+
+    Args:
+        db: An async database session, committed once all chunks are inserted.
+        model: The model to insert into.
+        schema: The pydantic schema each row has to satisfy.
+        rows: The raw rows from the request body.
+        check: Optional callable returning an error message for a validated row.
+        on_insert: Optional coroutine called with the session and the values of
+            the inserted rows, before the commit.
+        chunk_size: Number of rows sent per INSERT statement.
+
+    Returns:
+        A dict with the `created` rows (request index and new id) and the
+        per-row `errors`.
+    """
+    valid, errors = [], []
+    for index, row in enumerate(rows):
+        try:
+            item = schema.model_validate(row)
+        except ValidationError as exc:
+            errors.append({"index": index, "errors": exc.errors(include_url=False, include_context=False)})
+            continue
+        message = check(item) if check else None
+        if message:
+            errors.append({"index": index, "errors": [{"msg": message}]})
+            continue
+        valid.append((index, item.model_dump()))
+
+    stmt = insert(model).returning(model.id, sort_by_parameter_order=True)
+    created = []
+    for start in range(0, len(valid), chunk_size):
+        chunk = valid[start:start + chunk_size]
+        try:
+            async with db.begin_nested():
+                ids = (await db.scalars(stmt, [values for _, values in chunk])).all()
+            created.extend({"index": index, "id": id} for (index, _), id in zip(chunk, ids))
+        except DBAPIError:
+            for index, values in chunk:
+                try:
+                    async with db.begin_nested():
+                        id = await db.scalar(insert(model).values(values).returning(model.id))
+                    created.append({"index": index, "id": id})
+                except DBAPIError as exc:
+                    errors.append({"index": index, "errors": [{"msg": str(exc.orig)}]})
+
+    if on_insert and created:
+        inserted = {row["index"] for row in created}
+        await on_insert(db, [values for index, values in valid if index in inserted])
+    await db.commit()
+    errors.sort(key=lambda error: error["index"])
+    return {"created": created, "errors": errors}
+
+
+async def _export_rows(query, format):
+    # The request scoped session is closed before a streamed body is sent,
+    # so the generator owns its session for as long as the export runs.
+    # Exports are bulk reads and go to a replica when there is one.
+    async with read_sessionmaker()() as db:
+        result = await db.stream(query.execution_options(yield_per=EXPORT_BATCH_SIZE))
+        if format == "csv":
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(result.keys())
+            async for rows in result.partitions():
+                writer.writerows(rows)
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+            yield buffer.getvalue()
+        else:
+            async for rows in result.mappings().partitions():
+                yield b"".join(orjson.dumps(dict(row)) + b"\n" for row in rows)
+
+
+def export_response(query, format, filename):
+    """
+    Streaming the rows of a select statement as NDJSON or CSV.
+
+    Rows are read through a server-side cursor `EXPORT_BATCH_SIZE` at a time and
+    written out batch by batch, so memory stays flat whatever the table size.
+
+    Args:
+        query: A select statement over plain columns.
+        format: Either "ndjson" or "csv".
+        filename: Name suggested to the client for the download, without extension.
+
+    Returns:
+        A StreamingResponse producing the export.
+    """
+    return StreamingResponse(
+        _export_rows(query, format),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}.{format}"'},
+    )
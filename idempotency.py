@@ -0,0 +1,201 @@
+"""
+Idempotency keys for the create endpoints.
+
+A client retrying a POST sends the same `Idempotency-Key` header: the first
+request runs and its response is stored, the retries get the stored response
+back (with an `Idempotent-Replayed: true` header) without running the write
+again. Reusing a key with a different body is rejected with 422.
+
+Responses live in the `idempotency_keys` table for `idempotency_ttl` seconds,
+with an in-process LRU in front of it. A duplicate arriving while the first
+request is still running waits for its response: on the same worker on the
+first request's future, across workers by polling the key row.
+"""
+import asyncio
+import hashlib
+import os
+from datetime import datetime, timedelta
+
+import orjson
+from sqlalchemy import Column, DateTime, Integer, LargeBinary, String, delete, select, update
+
+from cache import LRUCache
+from custom_function import UPSERTS, Base, async_engine
+
+IDEMPOTENCY_TTL = int(os.getenv("idempotency_ttl", 86400))
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("idempotency_cache_size", 10000))
+# A key still running after this many seconds belongs to a request that died, a retry may take it over.
+IDEMPOTENCY_LOCK_TIMEOUT = float(os.getenv("idempotency_lock_timeout", 30))
+POLL_INTERVAL = 0.05
+# Expired keys are purged once every this many claims.
+PURGE_EVERY = 1000
+
+
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+
+    # sha256 of the path and the client key, so keys of any length take 64 characters.
+    key = Column(String(64), primary_key=True)
+    request_hash = Column(String(64), nullable=False)
+    # None while the first request is running.
+    status_code = Column(Integer)
+    content_type = Column(String(255))
+    body = Column(LargeBinary)
+    created_at = Column(DateTime, nullable=False)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+
+def _stored(row):
+    return (row.request_hash, row.status_code, row.content_type, row.body)
+
+
+async def _respond(send, status_code, content_type, body, replayed=False):
+    headers = [(b"content-type", content_type.encode()), (b"content-length", str(len(body)).encode())]
+    if replayed:
+        headers.append((b"idempotent-replayed", b"true"))
+    await send({"type": "http.response.start", "status": status_code, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+class IdempotencyMiddleware:
+    """
+    ASGI middleware honouring the `Idempotency-Key` header on the given POST paths.
+
+    Requests without the header, or on other paths, go straight through.
+    """
+
+    def __init__(self, app, paths=()):
+        self.app = app
+        self.paths = set(paths)
+        self.responses = LRUCache(maxsize=IDEMPOTENCY_CACHE_SIZE, ttl=IDEMPOTENCY_TTL)
+        self.running = {}
+        self.claims = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in self.paths:
+            return await self.app(scope, receive, send)
+        client_key = dict(scope["headers"]).get(b"idempotency-key")
+        if not client_key:
+            return await self.app(scope, receive, send)
+
+        key = hashlib.sha256(scope["path"].encode() + b" " + client_key).hexdigest()
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+        request_hash = hashlib.sha256(body).hexdigest()
+
+        while True:
+            stored = await self.responses.get(key)
+            if stored is not None:
+                return await self._replay(send, stored, request_hash)
+            running = self.running.get(key)
+            if running is not None:
+                await asyncio.shield(running)
+                continue
+
+            self.running[key] = running = asyncio.get_running_loop().create_future()
+            try:
+                claimed, stored = await self._claim(key, request_hash)
+                if claimed:
+                    return await self._run(scope, receive, send, key, body, request_hash)
+            finally:
+                del self.running[key]
+                running.set_result(None)
+            if stored is None:
+                # Another worker is running the first request.
+                await asyncio.sleep(POLL_INTERVAL)
+            else:
+                await self.responses.set(key, stored)
+
+    async def _replay(self, send, stored, request_hash):
+        stored_hash, status_code, content_type, body = stored
+        if stored_hash != request_hash:
+            detail = orjson.dumps({"detail": "Idempotency-Key was already used with a different request body"})
+            return await _respond(send, 422, "application/json", detail)
+        await _respond(send, status_code, content_type, body, replayed=True)
+
+    async def _claim(self, key, request_hash):
+        """
+        Taking the key for this request, unless another request holds it.
+
+        Returns:
+            `(True, None)` when taken, `(False, stored response)` when it already
+            completed, `(False, None)` while another request is running it.
+        """
+        now = datetime.now()
+        values = dict(
+            request_hash=request_hash, status_code=None, content_type=None, body=None,
+            created_at=now, expires_at=now + timedelta(seconds=IDEMPOTENCY_TTL),
+        )
+        async with async_engine.begin() as conn:
+            self.claims += 1
+            if self.claims % PURGE_EVERY == 0:
+                await conn.execute(delete(IdempotencyKey).where(IdempotencyKey.expires_at < now))
+
+            upsert = UPSERTS[conn.dialect.name]
+            claimed = await conn.scalar(
+                upsert(IdempotencyKey).values(key=key, **values)
+                .on_conflict_do_nothing(index_elements=["key"])
+                .returning(IdempotencyKey.key)
+            )
+            if claimed is not None:
+                return True, None
+
+            row = (await conn.execute(select(IdempotencyKey).where(IdempotencyKey.key == key))).first()
+            if row is None:
+                return False, None
+            abandoned = row.status_code is None and row.created_at < now - timedelta(seconds=IDEMPOTENCY_LOCK_TIMEOUT)
+            if row.expires_at <= now or abandoned:
+                # Compare-and-set on created_at, so only one of several retries takes it over.
+                taken = await conn.execute(
+                    update(IdempotencyKey)
+                    .where(IdempotencyKey.key == key, IdempotencyKey.created_at == row.created_at)
+                    .values(**values)
+                )
+                return taken.rowcount == 1, None
+            if row.status_code is None:
+                return False, None
+            return False, _stored(row)
+
+    async def _run(self, scope, receive, send, key, body, request_hash):
+        status_code = 500
+        content_type = "application/json"
+        chunks = []
+
+        async def receive_body():
+            nonlocal body
+            if body is None:
+                return await receive()
+            message = {"type": "http.request", "body": body, "more_body": False}
+            body = None
+            return message
+
+        async def send_wrapper(message):
+            nonlocal status_code, content_type
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                content_type = dict(message.get("headers", [])).get(b"content-type", b"application/json").decode()
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive_body, send_wrapper)
+        finally:
+            async with async_engine.begin() as conn:
+                if status_code >= 500:
+                    # Server errors are not stored, so a retry runs the request again.
+                    await conn.execute(
+                        delete(IdempotencyKey).where(IdempotencyKey.key == key, IdempotencyKey.status_code.is_(None))
+                    )
+                else:
+                    stored = (request_hash, status_code, content_type, b"".join(chunks))
+                    await conn.execute(
+                        update(IdempotencyKey)
+                        .where(IdempotencyKey.key == key)
+                        .values(status_code=status_code, content_type=content_type, body=stored[3])
+                    )
+                    await self.responses.set(key, stored)
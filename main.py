@@ -1,10 +1,40 @@
+import asyncio
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 from Order.apis import order_app
 from Product.apis import product_app
 from Warehouse.apis import warehouse_app
 from Supplier.apis import supplier_app
+from Monitoring.apis import monitoring_app
+from admission import AdmissionMiddleware
+from custom_function import async_engine, engine, replica_engines
+from idempotency import IdempotencyMiddleware
+from metrics import MetricsMiddleware, instrument_engine
+from migrations import MIGRATE_ON_STARTUP, finish, upgrade
+
+
+@asynccontextmanager
+async def lifespan(app):
+    if MIGRATE_ON_STARTUP:
+        async with async_engine.begin() as conn:
+            versions = await conn.run_sync(upgrade)
+        # Backfills and index builds run once the migrations are committed, in their own transactions.
+        await asyncio.to_thread(finish, engine, versions)
+    yield
+
+
+ROUTERS = ("/warehouse", "/supplier", "/orders", "/product")
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
+app.add_middleware(MetricsMiddleware, routers=ROUTERS)
+# Outside the metrics middleware: replayed responses do not count against the route query budgets.
+app.add_middleware(IdempotencyMiddleware, paths=("/orders/", "/product/", "/supplier/", "/warehouse/warehouse"))
+# Outermost: shed requests are turned away before the idempotency keys touch the database.
+app.add_middleware(AdmissionMiddleware, routers=ROUTERS)
+for instrumented in (async_engine, *replica_engines):
+    instrument_engine(instrumented.sync_engine)
 
 #Include all routers
 app.include_router(warehouse_app, prefix="/warehouse")
@@ -12,3 +42,4 @@ app.include_router(supplier_app, prefix="/supplier")
 
 app.include_router(order_app, prefix="/orders")
 app.include_router(product_app, prefix="/product")
+app.include_router(monitoring_app)
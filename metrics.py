@@ -0,0 +1,282 @@
+import logging
+import os
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+# The same statement run this many times in one request is reported as a likely N+1.
+N_PLUS_ONE_THRESHOLD = int(os.getenv("n_plus_one_threshold", 5))
+DB_QUERY_HEADER = os.getenv("db_query_header", "false").lower() in ("1", "true", "yes")
+
+
+class Histogram:
+    """
+    Cumulative histogram in the Prometheus sense, one counter per upper bound.
+    """
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+
+class RequestDB:
+    """
+    Database work done while serving one request, filled by the engine events.
+
+    `repeats` counts executions per SQL text: the text only holds placeholders,
+    so statements differing only in their parameters share one entry.
+    """
+
+    __slots__ = ("statements", "time", "repeats", "budget", "allow_repeats")
+
+    def __init__(self):
+        self.statements = 0
+        self.time = 0.0
+        self.repeats = defaultdict(int)
+        self.budget = None
+        self.allow_repeats = False
+
+    def record(self, statement, elapsed):
+        self.statements += 1
+        self.time += elapsed
+        self.repeats[statement] += 1
+
+    def check(self, route):
+        """
+        Logging a warning when the request went over its query budget or looks like an N+1.
+        """
+        if self.budget is not None and self.statements > self.budget:
+            logger.warning("%s ran %d queries, over its budget of %d", route, self.statements, self.budget)
+        if not self.allow_repeats:
+            for statement, count in self.repeats.items():
+                if count >= N_PLUS_ONE_THRESHOLD:
+                    logger.warning("%s ran the same statement %d times, likely N+1: %s", route, count, statement)
+
+
+request_db = ContextVar("request_db", default=None)
+
+
+class Metrics:
+    """
+    In-process registry of the request and database metrics.
+
+    Everything is plain counters updated from the event loop thread, so
+    recording a request costs a couple of dict lookups and no locking.
+    """
+
+    def __init__(self):
+        self.requests = defaultdict(int)
+        self.in_flight = defaultdict(int)
+        self.latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.db_time = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.db_statements = defaultdict(lambda: Histogram(STATEMENT_BUCKETS))
+        self.gauges = []
+        self.collectors = []
+
+    def add_gauges(self, collect):
+        """
+        Registering a callable returning extra `{name: value}` gauges at scrape time.
+        """
+        self.gauges.append(collect)
+
+    def add_collector(self, render):
+        """
+        Registering a callable returning extra, already formatted, exposition lines at scrape time.
+        """
+        self.collectors.append(render)
+
+    def observe(self, method, route, status_code, seconds, db):
+        key = (method, route)
+        self.requests[(method, route, status_code)] += 1
+        self.latency[key].observe(seconds)
+        self.db_time[key].observe(db.time)
+        self.db_statements[key].observe(db.statements)
+
+    def render(self):
+        lines = [
+            "# HELP http_requests_total Requests served, by route and status code.",
+            "# TYPE http_requests_total counter",
+        ]
+        for (method, route, status_code), count in sorted(self.requests.items()):
+            lines.append(f'http_requests_total{{method="{method}",route="{route}",status="{status_code}"}} {count}')
+
+        lines += [
+            "# HELP http_requests_in_flight Requests being served, by router.",
+            "# TYPE http_requests_in_flight gauge",
+        ]
+        for router, count in sorted(self.in_flight.items()):
+            lines.append(f'http_requests_in_flight{{router="{router}"}} {count}')
+
+        for name, kind, histograms in (
+            ("http_request_duration_seconds", "Request latency", self.latency),
+            ("db_time_per_request_seconds", "Time spent in database statements per request", self.db_time),
+            ("db_statements_per_request", "Database statements executed per request", self.db_statements),
+        ):
+            lines += [f"# HELP {name} {kind}, by route.", f"# TYPE {name} histogram"]
+            for (method, route), histogram in sorted(histograms.items()):
+                lines += histogram.render(name, f'method="{method}",route="{route}"')
+
+        for collect in self.gauges:
+            for name, value in collect().items():
+                lines += [f"# TYPE {name} gauge", f"{name} {value}"]
+        for render in self.collectors:
+            lines += render()
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+def instrument_engine(engine):
+    """
+    Counting statements and database time of the current request from the engine events.
+
+    Args:
+        engine: The engine to instrument, for an AsyncEngine pass its `sync_engine`.
+    """
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        db = request_db.get()
+        if db is not None:
+            db.record(statement, elapsed)
+
+
+def query_budget(limit=None, allow_repeats=False):
+    """
+    Declaring how many statements a route may run, as a route dependency:
+
+        @product_app.get("/", dependencies=[Depends(query_budget(1))])
+
+    Requests going over the budget are logged by `MetricsMiddleware`.
+
+    Args:
+        limit: Maximum number of statements per request, None for no limit.
+        allow_repeats: Do not report repeated statements as N+1, for routes
+            repeating a statement on purpose.
+    """
+
+    async def declare_budget():
+        db = request_db.get()
+        if db is not None:
+            db.budget = limit
+            db.allow_repeats = allow_repeats
+
+    return declare_budget
+
+
+class QueryCounter:
+    __slots__ = ("statements", "repeats")
+
+    def __init__(self):
+        self.statements = []
+        self.repeats = defaultdict(int)
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+
+@contextmanager
+def count_queries(*engines):
+    """
+    Collecting every statement run on `engines` inside the block, whatever task or thread runs it.
+
+    Meant for tests, e.g. with a TestClient which serves requests from another thread.
+    """
+    counter = QueryCounter()
+
+    def _count(conn, cursor, statement, parameters, context, executemany):
+        counter.statements.append(statement)
+        counter.repeats[statement] += 1
+
+    for engine in engines:
+        event.listen(engine, "after_cursor_execute", _count)
+    try:
+        yield counter
+    finally:
+        for engine in engines:
+            event.remove(engine, "after_cursor_execute", _count)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording latency, in-flight requests and database usage per route.
+
+    It also enforces the route query budgets and, when `db_query_header` is
+    enabled, reports the statement count in an `X-DB-Queries` response header.
+
+    Routes are labelled with their path template (e.g. `/product/{product_id}`)
+    and in-flight requests with their router prefix, so label cardinality stays
+    bounded; anything else shares the "unmatched"/"other" labels.
+    """
+
+    def __init__(self, app, routers=()):
+        self.app = app
+        self.routers = set(routers)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        router = "/" + scope["path"].lstrip("/").split("/", 1)[0]
+        if router not in self.routers:
+            router = "other"
+        status_code = 500
+
+        db = RequestDB()
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                if DB_QUERY_HEADER:
+                    message["headers"] = [*message.get("headers", []), (b"x-db-queries", str(db.statements).encode())]
+            await send(message)
+
+        token = request_db.set(db)
+        metrics.in_flight[router] += 1
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            metrics.in_flight[router] -= 1
+            request_db.reset(token)
+            route = scope.get("route")
+            route = route.path if route else "unmatched"
+            metrics.observe(scope["method"], route, status_code, elapsed, db)
+            db.check(f"{scope['method']} {route}")
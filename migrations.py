@@ -0,0 +1,335 @@
+"""
+Versioned schema migrations.
+
+Every migration runs once, in version order, and is recorded in
+`schema_migrations`. They are applied at application startup (see `main.py`,
+disable with `migrate_on_startup = false`) or by hand with
+
+    python -m migrations
+
+Migrations only create what is missing, so they also bring databases created
+by the former `create_all` at import time up to date. Each one spells out the
+tables, columns and indexes it creates rather than reading them from the
+models, so editing a model never changes what an old migration does: a model
+change needs a new migration.
+
+Work that would hold the migration transaction (and its locks) for long on a
+large table, such as backfills and PostgreSQL index builds, is registered as a
+deferred step of its migration instead: `finish` runs it once the migration is
+committed, batch by batch or with `CONCURRENTLY`.
+"""
+import logging
+import os
+from datetime import datetime
+
+from sqlalchemy import (
+    Boolean, Column, Date, DateTime, Float, ForeignKey, Integer, LargeBinary, MetaData, String, Table, false, insert,
+    inspect, select, text,
+)
+from sqlalchemy.schema import CreateColumn
+
+import Product.models, Supplier.models, Warehouse.models  # noqa: F401, registers the tables the backfills join
+from custom_function import Base, engine
+from Order import rollup, totals
+
+logger = logging.getLogger(__name__)
+
+MIGRATE_ON_STARTUP = os.getenv("migrate_on_startup", "true").lower() in ("1", "true", "yes")
+# Key of the PostgreSQL advisory lock taken while migrating, so workers starting together migrate one at a time.
+MIGRATION_LOCK_ID = 7_301_017
+
+schema_migrations = Table(
+    "schema_migrations",
+    Base.metadata,
+    Column("version", Integer, primary_key=True),
+    Column("name", String(255), nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+MIGRATIONS = []
+# Deferred steps by version, called with the sync engine once the migration is committed.
+DEFERRED = {}
+
+
+def migration(version, name, deferred=None):
+    def register(apply):
+        MIGRATIONS.append((version, name, apply))
+        if deferred is not None:
+            DEFERRED[version] = deferred
+        return apply
+
+    return register
+
+
+# The tables as the migrations create them, apart from the models' metadata.
+frozen = MetaData()
+
+
+def _index_ddl(dialect_name, index, concurrently=False):
+    """
+    The CREATE INDEX of an `(name, table, columns, postgresql)` index.
+
+    `columns` is the column list, `postgresql` what follows the table name on
+    PostgreSQL when it differs (e.g. `USING gin (...)`); a None `columns` is
+    an index only PostgreSQL gets.
+    """
+    name, table, columns, postgresql = index
+    definition = postgresql if dialect_name == "postgresql" and postgresql else f"({columns})"
+    return f"CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}IF NOT EXISTS {name} ON {table} {definition}"
+
+
+def _create_indexes(conn, indexes, drop=()):
+    # PostgreSQL builds them in the deferred step of `_build_indexes`, other databases right away.
+    if conn.dialect.name == "postgresql":
+        return
+    for name in drop:
+        conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+    for index in indexes:
+        if index[2] is not None:
+            conn.execute(text(_index_ddl(conn.dialect.name, index)))
+
+
+def _build_indexes(indexes, drop=()):
+    """
+    The deferred step building `indexes` on PostgreSQL without blocking writes, then dropping `drop` the same way.
+
+    A build that was interrupted leaves an invalid index behind, drop it before
+    running the step again.
+    """
+
+    def build(bind):
+        if bind.dialect.name != "postgresql":
+            return
+        with bind.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            for index in indexes:
+                conn.execute(text(_index_ddl("postgresql", index, concurrently=True)))
+            for name in drop:
+                conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+
+    return build
+
+
+def _add_columns(conn, table, *columns):
+    existing = {column["name"] for column in inspect(conn).get_columns(table)}
+    for column in columns:
+        if column.name not in existing:
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {CreateColumn(column).compile(conn)}"))
+
+
+INITIAL_TABLES = (
+    Table(
+        "suppliers", frozen,
+        Column("id", Integer, primary_key=True),
+        Column("name", String(255), nullable=False),
+        Column("contact_info", String(255)),
+    ),
+    Table(
+        "warehouses", frozen,
+        Column("id", Integer, primary_key=True),
+        Column("location", String(255), nullable=False),
+        Column("capacity", Integer),
+    ),
+    Table(
+        "products", frozen,
+        Column("id", Integer, primary_key=True),
+        Column("name", String(255), nullable=False),
+        Column("description", String(255)),
+        Column("price", Float),
+        Column("supplier_id", Integer, ForeignKey("suppliers.id")),
+        Column("stock", Integer),
+        Column("warehouse_id", Integer, ForeignKey("warehouses.id")),
+    ),
+    Table(
+        "orders", frozen,
+        Column("id", Integer, primary_key=True),
+        Column("customer_name", String(255), nullable=False),
+        Column("customer_address", String(255)),
+        Column("order_date", DateTime),
+        Column("status", String, nullable=False),
+    ),
+    Table(
+        "order_items", frozen,
+        Column("id", Integer, primary_key=True),
+        Column("order_id", Integer, ForeignKey("orders.id")),
+        Column("product_id", Integer, ForeignKey("products.id")),
+        Column("quantity", Integer),
+        Column("price", Float),
+    ),
+)
+
+
+@migration(1, "initial schema")
+def _initial_schema(conn):
+    for table in INITIAL_TABLES:
+        table.create(conn, checkfirst=True)
+
+
+PRODUCT_SEARCH_INDEXES = (
+    ("ix_products_name_trgm", "products", None, "USING gin (name gin_trgm_ops)"),
+    ("ix_products_description_trgm", "products", None, "USING gin (description gin_trgm_ops)"),
+)
+
+
+@migration(2, "product search trigram indexes", deferred=_build_indexes(PRODUCT_SEARCH_INDEXES))
+def _product_search_indexes(conn):
+    if conn.dialect.name == "postgresql":
+        conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+
+
+ORDER_STATS_TABLE = Table(
+    "order_stats_daily", frozen,
+    Column("day", Date, primary_key=True),
+    Column("status", String, primary_key=True),
+    Column("shard", Integer, primary_key=True),
+    Column("order_count", Integer, nullable=False),
+    Column("revenue", Float, nullable=False),
+)
+
+
+def _rebuild_order_stats(bind):
+    with bind.begin() as conn:
+        if conn.dialect.name == "postgresql":
+            # Order writes recording into the rollup meanwhile wait for the rebuild, so they are counted once.
+            conn.execute(text("LOCK TABLE order_stats_daily IN EXCLUSIVE MODE"))
+        rollup.rebuild(conn)
+
+
+@migration(3, "order stats rollup", deferred=_rebuild_order_stats)
+def _order_stats_rollup(conn):
+    ORDER_STATS_TABLE.create(conn, checkfirst=True)
+
+
+FOREIGN_KEY_INDEXES = (
+    ("ix_products_supplier_id", "products", "supplier_id", None),
+    ("ix_products_warehouse_id_stock", "products", "warehouse_id, stock", None),
+    ("ix_order_items_order_id", "order_items", "order_id", None),
+    ("ix_order_items_product_id", "order_items", "product_id", None),
+    ("ix_orders_order_date", "orders", "order_date", None),
+    ("ix_orders_status_order_date", "orders", "status, order_date", None),
+)
+
+
+@migration(4, "foreign key and order indexes", deferred=_build_indexes(FOREIGN_KEY_INDEXES))
+def _foreign_key_indexes(conn):
+    _create_indexes(conn, FOREIGN_KEY_INDEXES)
+
+
+IDEMPOTENCY_KEYS_TABLE = Table(
+    "idempotency_keys", frozen,
+    Column("key", String(64), primary_key=True),
+    Column("request_hash", String(64), nullable=False),
+    Column("status_code", Integer),
+    Column("content_type", String(255)),
+    Column("body", LargeBinary),
+    Column("created_at", DateTime, nullable=False),
+    Column("expires_at", DateTime, nullable=False),
+)
+IDEMPOTENCY_KEYS_INDEXES = (("ix_idempotency_keys_expires_at", "idempotency_keys", "expires_at", None),)
+
+
+@migration(5, "idempotency keys", deferred=_build_indexes(IDEMPOTENCY_KEYS_INDEXES))
+def _idempotency_keys(conn):
+    IDEMPOTENCY_KEYS_TABLE.create(conn, checkfirst=True)
+    _create_indexes(conn, IDEMPOTENCY_KEYS_INDEXES)
+
+
+ORDER_FILTER_INDEXES = (
+    ("ix_orders_order_date_id", "orders", "order_date, id", None),
+    ("ix_orders_status_id", "orders", "status, id", None),
+    ("ix_orders_status_order_date_id", "orders", "status, order_date, id", None),
+    ("ix_orders_customer_name", "orders", "customer_name", "(customer_name varchar_pattern_ops)"),
+)
+# Superseded by the same indexes ending with the id, which also serve the keyset order.
+SUPERSEDED_ORDER_INDEXES = ("ix_orders_order_date", "ix_orders_status_order_date")
+
+
+@migration(
+    6, "order list filter indexes",
+    deferred=_build_indexes(ORDER_FILTER_INDEXES, drop=SUPERSEDED_ORDER_INDEXES),
+)
+def _order_filter_indexes(conn):
+    _create_indexes(conn, ORDER_FILTER_INDEXES, drop=SUPERSEDED_ORDER_INDEXES)
+
+
+@migration(7, "stored order totals", deferred=totals.repair)
+def _order_totals(conn):
+    # Existing orders start at 0, the deferred `totals.repair` fills them one batch per transaction.
+    _add_columns(
+        conn, "orders",
+        Column("total", Float, nullable=False, server_default="0"),
+        Column("item_count", Integer, nullable=False, server_default="0"),
+    )
+
+
+@migration(8, "order stock reservations")
+def _order_stock_reserved(conn):
+    # Existing orders never reserved stock: they start false, so cancelling or deleting them gives nothing back.
+    _add_columns(conn, "orders", Column("stock_reserved", Boolean, nullable=False, server_default=false()))
+
+
+def upgrade(conn):
+    """
+    Applying the pending migrations in one transaction.
+
+    Args:
+        conn: A sync connection, the caller commits. With an async engine use
+            `await conn.run_sync(upgrade)`.
+
+    Returns:
+        The versions that were applied.
+    """
+    if conn.dialect.name == "postgresql":
+        conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATION_LOCK_ID})
+    schema_migrations.create(conn, checkfirst=True)
+    applied = set(conn.scalars(select(schema_migrations.c.version)))
+
+    versions = []
+    for version, name, apply in sorted(MIGRATIONS):
+        if version in applied:
+            continue
+        logger.info("Applying migration %d: %s", version, name)
+        apply(conn)
+        conn.execute(insert(schema_migrations).values(version=version, name=name, applied_at=datetime.now()))
+        versions.append(version)
+    return versions
+
+
+def finish(bind, versions):
+    """
+    Running the deferred steps of the migrations just applied, outside their transaction.
+
+    Only the process that applied a migration runs its steps. If one is
+    interrupted, run it again by hand with `python -m migrations --finish <version>`.
+
+    Args:
+        bind: A sync engine, the steps manage their own transactions.
+        versions: The versions returned by `upgrade`, once committed.
+    """
+    for version in versions:
+        if version in DEFERRED:
+            logger.info("Finishing migration %d", version)
+            DEFERRED[version](bind)
+
+
+def migrate(bind=engine):
+    with bind.begin() as conn:
+        versions = upgrade(conn)
+    finish(bind, versions)
+    return versions
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Apply the pending schema migrations.")
+    parser.add_argument(
+        "--finish", type=int, nargs="+", metavar="VERSION", help="only rerun the deferred steps of these migrations",
+    )
+    args = parser.parse_args()
+
+    if args.finish:
+        finish(engine, args.finish)
+        print(f"Finished migrations {args.finish}")
+    else:
+        versions = migrate()
+        print(f"Applied migrations {versions}" if versions else "Schema is up to date")